@@ -0,0 +1,286 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from scipy import sparse
+
+from neighbors import file_digest
+from scoring import score_row, top_k
+
+ANN_DIR = 'artifacts'
+ANN_FILES = ('centroid_data', 'centroid_indices', 'centroid_indptr', 'offsets', 'rows')
+META_FILE = 'ann_meta.json'
+FORMAT_VERSION = 1
+DEFAULT_NPROBE = 8
+CENTROID_TERMS = 256  # Heaviest terms kept per centroid, so centroids stay sparse
+KMEANS_ITERATIONS = 10
+TRAINING_SAMPLE = 50_000  # Rows k-means is fitted on; every row is then assigned
+ASSIGN_BLOCK_SIZE = 4096  # Rows compared with the centroids at a time
+
+
+def sparse_centroids(sums, terms=CENTROID_TERMS):
+    """Unit-length CSR centroids from per-cluster sums, keeping each row's heaviest terms"""
+    sums = sums.tocsr()
+    sums.sum_duplicates()
+    data, indices, indptr = [], [], [0]
+    for i in range(sums.shape[0]):
+        row_data = sums.data[sums.indptr[i]:sums.indptr[i + 1]]
+        row_indices = sums.indices[sums.indptr[i]:sums.indptr[i + 1]]
+        if len(row_data) > terms:
+            keep = np.sort(np.argpartition(-row_data, terms - 1)[:terms])
+            row_data, row_indices = row_data[keep], row_indices[keep]
+        norm = np.linalg.norm(row_data)
+        data.append(row_data / norm if norm > 0 else row_data)
+        indices.append(row_indices)
+        indptr.append(indptr[-1] + len(row_data))
+    return sparse.csr_matrix((np.concatenate(data).astype(np.float32), np.concatenate(indices).astype(np.int32),
+                              np.array(indptr, dtype=np.int64)), shape=sums.shape)
+
+
+def nearest_lists(matrix, centroids_t, block_size=ASSIGN_BLOCK_SIZE):
+    """Index of the closest centroid (highest cosine) for every row; rows
+    sharing no term with any centroid go to list 0"""
+    labels = np.empty(matrix.shape[0], dtype=np.int32)
+    for start in range(0, matrix.shape[0], block_size):
+        block = matrix[start:start + block_size].dot(centroids_t).toarray()
+        labels[start:start + block_size] = np.argmax(block, axis=1)
+    return labels
+
+
+def spherical_kmeans(matrix, n_clusters, iterations=KMEANS_ITERATIONS, terms=CENTROID_TERMS, seed=0):
+    """Sparse unit-length centroids of n_clusters clusters of the L2-normalized
+    rows (k-means on cosine similarity)"""
+    rng = np.random.default_rng(seed)
+    centroids = sparse_centroids(matrix[rng.choice(matrix.shape[0], n_clusters, replace=False)], terms)
+    for iteration in range(iterations):
+        labels = nearest_lists(matrix, centroids.T.tocsr())
+        # Sum of each cluster's members as one sparse product
+        membership = sparse.csr_matrix((np.ones(len(labels)), (labels, np.arange(len(labels)))),
+                                       shape=(n_clusters, matrix.shape[0]))
+        sums = (membership @ matrix).tolil()
+        empty = np.flatnonzero(np.bincount(labels, minlength=n_clusters) == 0)
+        # Clusters that lost every member restart from random rows
+        for cluster, row in zip(empty, rng.choice(matrix.shape[0], len(empty), replace=False)):
+            sums[cluster] = matrix[row]
+        centroids = sparse_centroids(sums, terms)
+        print(f"k-means iteration {iteration + 1}/{iterations} ({len(empty)} empty clusters)")
+    return centroids
+
+
+class IVFIndex:
+    """Approximate nearest neighbors over the TF-IDF rows (inverted file index).
+
+    Rows are grouped into lists around spherical k-means centroids, each
+    centroid kept sparse as its heaviest terms. A query probes the nprobe
+    lists whose centroids it is closest to, and only the rows in them are
+    scored exactly against the TF-IDF vectors, so results keep exact scores
+    and ordering but may miss songs in unprobed lists. More lists or fewer
+    probes make queries faster and recall lower."""
+
+    def __init__(self, centroids, offsets, rows):
+        self.centroids = centroids  # float32 CSR (lists x vocabulary), unit rows
+        self.centroids_t = centroids.T.tocsr()  # for query-times-centroids products
+        self.offsets = offsets  # int64 (lists + 1); list i is rows[offsets[i]:offsets[i + 1]]
+        self.rows = rows  # int32 catalog rows grouped by list, ascending within each
+
+    @classmethod
+    def build(cls, matrix, n_lists=None, terms=CENTROID_TERMS, sample=TRAINING_SAMPLE, seed=0):
+        """Fit the centroids on a sample of rows and assign every row.
+        n_lists defaults to the square root of the row count."""
+        n_rows = matrix.shape[0]
+        rng = np.random.default_rng(seed)
+        training_rows = np.sort(rng.choice(n_rows, min(sample, n_rows), replace=False))
+        n_lists = max(1, min(n_lists or int(round(np.sqrt(n_rows))), len(training_rows)))
+
+        print(f"Clustering {len(training_rows)} rows into {n_lists} lists...")
+        centroids = spherical_kmeans(matrix[training_rows], n_lists, terms=terms, seed=seed)
+        offsets, rows = group_rows(nearest_lists(matrix, centroids.T.tocsr()), n_lists)
+        return cls(centroids, offsets, rows)
+
+    @property
+    def n_lists(self):
+        return self.centroids.shape[0]
+
+    def candidates(self, query, nprobe):
+        """Rows in the nprobe lists closest to a 1 x V query row, ascending"""
+        similarities = query.dot(self.centroids_t).toarray().ravel()
+        nprobe = max(1, min(nprobe, self.n_lists))
+        lists = np.argpartition(-similarities, nprobe - 1)[:nprobe]
+        return np.sort(np.concatenate([self.rows[self.offsets[i]:self.offsets[i + 1]] for i in lists]))
+
+    def search(self, matrix, query, k, nprobe=DEFAULT_NPROBE, exclude=None, mask=None):
+        """Top k rows for a normalized 1 x V query row among the probed lists,
+        ranked by exact cosine like top_k. Returns None when the probed lists
+        hold fewer than k allowed rows, so the caller can score exactly instead."""
+        rows = self.candidates(query, nprobe)
+        if exclude is not None:
+            rows = rows[~np.isin(rows, exclude)]
+        if mask is not None:
+            rows = rows[mask[rows]]
+        if len(rows) < k:
+            return None
+        scores = matrix[rows].dot(query.T).toarray().ravel()
+        return rows[top_k(scores, k)]
+
+    def append(self, rows, first_row):
+        """New index with sparse TF-IDF rows appended as catalog rows first_row on.
+        New rows join the list of their closest centroid; centroids are not refitted."""
+        labels = nearest_lists(rows, self.centroids_t)
+        new_rows = np.arange(first_row, first_row + len(labels), dtype=np.int32)
+        # Appended rows go at the end of their list, keeping each list ascending
+        order = np.argsort(labels, kind='stable')
+        grouped = np.insert(self.rows, self.offsets[labels[order] + 1], new_rows[order])
+        added = np.bincount(labels, minlength=self.n_lists)
+        offsets = self.offsets + np.concatenate([[0], np.cumsum(added)])
+        return IVFIndex(self.centroids, offsets, grouped)
+
+    def arrays(self):
+        return {'centroid_data': self.centroids.data, 'centroid_indices': self.centroids.indices,
+                'centroid_indptr': self.centroids.indptr, 'offsets': self.offsets, 'rows': self.rows}
+
+    @classmethod
+    def from_arrays(cls, arrays, n_terms):
+        centroids = sparse.csr_matrix((arrays['centroid_data'], arrays['centroid_indices'], arrays['centroid_indptr']),
+                                      shape=(len(arrays['offsets']) - 1, n_terms), copy=False)
+        return cls(centroids, arrays['offsets'], arrays['rows'])
+
+
+def group_rows(labels, n_lists):
+    """(offsets, rows) of an inverted file from each row's list label"""
+    rows = np.argsort(labels, kind='stable').astype(np.int32)
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=n_lists), out=offsets[1:])
+    return offsets, rows
+
+
+def save_ann(index, source_file, directory=ANN_DIR):
+    """Write the index arrays plus a sidecar recording which catalog they describe.
+    Files are renamed into place, as in save_neighbors."""
+    os.makedirs(directory, exist_ok=True)
+    for name, array in index.arrays().items():
+        tmp_path = os.path.join(directory, f'ann_{name}.npy.tmp-{os.getpid()}.npy')
+        np.save(tmp_path, array)
+        os.replace(tmp_path, os.path.join(directory, f'ann_{name}.npy'))
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'source_file': os.path.basename(source_file),
+        'source_sha256': file_digest(source_file),
+        'n_rows': int(len(index.rows)),
+        'lists': int(index.n_lists),
+        'terms': int(index.centroids.shape[1]),
+        'built_at': time.time(),
+    }
+    tmp_path = os.path.join(directory, f'{META_FILE}.tmp-{os.getpid()}')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, os.path.join(directory, META_FILE))
+
+
+def load_ann(source_digest, n_rows, directory=ANN_DIR):
+    """Memory-map the index, or return None if missing or built from a catalog
+    other than the one with this SHA-256"""
+    meta_path = os.path.join(directory, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    if meta.get('format_version') != FORMAT_VERSION or meta.get('n_rows') != n_rows \
+            or meta.get('source_sha256') != source_digest:
+        print("ANN index is stale, falling back to exact scoring")
+        return None
+
+    try:
+        arrays = {name: np.load(os.path.join(directory, f'ann_{name}.npy'), mmap_mode='r') for name in ANN_FILES}
+    except (OSError, ValueError) as e:
+        print(f"Could not load ANN index: {str(e)}")
+        return None
+
+    return IVFIndex.from_arrays(arrays, meta['terms'])
+
+
+def evaluate(index, matrix, matrix_t, nprobes, k=10, queries=200, seed=0):
+    """Recall@k and latency of the index against exact scoring, for random
+    catalog rows as seeds. Returns one dict per nprobe, plus the exact timings."""
+    rng = np.random.default_rng(seed)
+    seeds = rng.choice(matrix.shape[0], min(queries, matrix.shape[0]), replace=False)
+
+    exact = {}
+    exact_times = []
+    for idx in seeds:
+        start = time.perf_counter()
+        exact[idx] = top_k(score_row(matrix, matrix_t, idx), k, exclude=idx)
+        exact_times.append(time.perf_counter() - start)
+
+    results = []
+    for nprobe in nprobes:
+        recalls, times, candidates, fallbacks = [], [], [], 0
+        for idx in seeds:
+            start = time.perf_counter()
+            found = index.search(matrix, matrix[idx], k, nprobe, exclude=idx)
+            times.append(time.perf_counter() - start)
+            if found is None:
+                # Served by exact scoring in the app
+                fallbacks += 1
+                found = exact[idx]
+            candidates.append(len(index.candidates(matrix[idx], nprobe)))
+            if len(exact[idx]):
+                recalls.append(len(np.intersect1d(found, exact[idx])) / len(exact[idx]))
+        results.append({
+            'nprobe': nprobe,
+            'recall': float(np.mean(recalls)),
+            'mean_ms': float(np.mean(times) * 1000),
+            'p99_ms': float(np.percentile(times, 99) * 1000),
+            'candidates': float(np.mean(candidates)),
+            'fallbacks': fallbacks,
+        })
+    return results, {'mean_ms': float(np.mean(exact_times) * 1000), 'p99_ms': float(np.percentile(exact_times, 99) * 1000)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the approximate nearest neighbor index and measure its recall")
+    parser.add_argument('--lists', type=int, default=0,
+                        help="k-means lists (default: square root of the catalog size)")
+    parser.add_argument('--terms', type=int, default=CENTROID_TERMS,
+                        help="heaviest terms kept per centroid")
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32],
+                        help="probe counts to evaluate")
+    parser.add_argument('--k', type=int, default=10,
+                        help="neighbors compared for recall@k")
+    parser.add_argument('--queries', type=int, default=200,
+                        help="random seed songs to evaluate")
+    parser.add_argument('--evaluate-only', action='store_true',
+                        help="evaluate the saved index instead of building one")
+    args = parser.parse_args()
+    if args.lists < 0:
+        parser.error("--lists must be at least 1 (or 0 for the default)")
+    if min(args.nprobe) < 1:
+        parser.error("--nprobe values must be at least 1")
+
+    import app
+
+    current = app.model
+    if current.embedding is not None:
+        parser.error("the ANN index works on TF-IDF vectors; unset SIMILARITY_MODEL to use it")
+    if args.evaluate_only:
+        index = load_ann(current.source_digest, current.tfidf_matrix.shape[0])
+        if index is None:
+            parser.error("no ANN index for the current catalog; build one first")
+    else:
+        index = IVFIndex.build(current.tfidf_matrix, args.lists or None, args.terms)
+        save_ann(index, app.DATA_FILE)
+        print(f"Saved ANN index with {index.n_lists} lists to {ANN_DIR}/")
+
+    results, exact = evaluate(index, current.tfidf_matrix, current.tfidf_matrix_t, args.nprobe, args.k, args.queries)
+    print(f"exact: {exact['mean_ms']:.2f} ms mean, {exact['p99_ms']:.2f} ms p99")
+    print(f"{'nprobe':>6} {f'recall@{args.k}':>10} {'mean (ms)':>10} {'p99 (ms)':>9} {'candidates':>11} {'fallbacks':>10}")
+    for result in results:
+        print(f"{result['nprobe']:>6} {result['recall']:>10.3f} {result['mean_ms']:>10.2f} {result['p99_ms']:>9.2f} "
+              f"{result['candidates']:>11.0f} {result['fallbacks']:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,76 +2,602 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 import pandas as pd
 import numpy as np
+from scipy import sparse
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 import os
 import json
+import time
+import contextlib
+import hashlib
+import hmac
+import threading
+
+from scoring import prepare_matrix, transpose_matrix, score_row, score_rows, centroid_query, score_query, top_k
+from neighbors import file_digest, load_neighbors, append_neighbors, save_neighbors
+from ann import load_ann, save_ann
+from embedding import Embedding
+from audio_features import AUDIO_FEATURE_COLUMNS, FeatureMatrix, blend_scores
+from model_store import build_lock, load_csr, load_model, save_arrays, save_model, save_vectorizer, write_model
+from facets import FACET_COLUMNS, Facet, build_facets, build_year_array, facet_catalog, filter_mask, normalize_value
+from lookup import TrigramIndex, TitleIndex, SearchIndex, PrefixIndex, normalize_text
+from song_store import SongStore, EncodedRows, encode_response, restore_song_store
+from stream_build import count_terms, write_embedding, write_indexes, write_tfidf
+from strings import nested_arrays
+from catalog import Catalog, text_values, write_catalog
+from cache import LRUCache
+from parallel_build import StageTimer, fit_tfidf, resolve_workers
+from batcher import MicroBatcher
+from reloader import Reloader
 
 app = Flask(__name__)
 CORS(app)
 
-# Global variables to store the model and data
-data = None
-tfidf_matrix = None
-cosine_sim = None
-tfidf = None
+DATA_FILE = os.environ.get('CATALOG_FILE', 'music_data.csv')  # .csv, .parquet or .feather
+FEATURE_COLUMNS = ['genre', 'artist_name', 'track_name', 'language', 'mood']  # Text fed to TF-IDF
+INDEX_COLUMNS = ['track_name', 'artist_name', 'year'] + FACET_COLUMNS
+SONG_FIELDS = ['track_name', 'artist_name', 'genre', 'year', 'language', 'mood']
+SEARCH_DEFAULT_LIMIT = 50
+SEARCH_MAX_LIMIT = 500
+SUGGEST_DEFAULT_LIMIT = 8
+SUGGEST_MAX_LIMIT = 10
+SONGS_MAX_LIMIT = 1000  # Page size cap for /api/songs; streaming has none
+SONGS_STREAM_BATCH = 1000  # Rows encoded per chunk of a streamed song list
+BATCH_MAX_SEEDS = 500
+BATCH_BLOCK_SIZE = 64  # Seeds scored per sparse product; bounds the dense score block
+# Batch request fields that apply to every seed unless the seed sets its own
+BATCH_SEED_DEFAULTS = ['mood_filter', 'language_filter', 'genre_filter', 'year_min', 'year_max',
+                       'feature_weight', 'feature_target']
+PLAYLIST_MAX_SEEDS = 200
+RECOMMENDATION_CACHE_SIZE = int(os.environ.get('RECOMMENDATION_CACHE_SIZE', 4096))
+RECOMMENDATION_CACHE_TTL = int(os.environ.get('RECOMMENDATION_CACHE_TTL', 3600))
+MODEL_CACHE_ENABLED = os.environ.get('MODEL_CACHE', '1') != '0'
+# Processes tokenizing the catalog when the model is built (0 = one per CPU, 1 = in-process)
+BUILD_WORKERS = resolve_workers(int(os.environ.get('BUILD_WORKERS', 1)))
+# Rows per chunk when building the model out of core, straight from the catalog
+# file into the artifact cache (0 = load the whole catalog into memory instead)
+STREAM_CHUNK_ROWS = int(os.environ.get('STREAM_CHUNK_ROWS', 0))
+# Song metadata shards of a streamed model kept memory-mapped at once
+OPEN_SONG_SHARDS = int(os.environ.get('OPEN_SONG_SHARDS', 8))
+# Lists of the ANN index probed per query (when one is built): more is slower with higher recall
+ANN_NPROBE = int(os.environ.get('ANN_NPROBE', 8))
+if ANN_NPROBE < 1:
+    raise ValueError(f"ANN_NPROBE must be at least 1, not {ANN_NPROBE}")
+# Concurrent single-seed recommendations that need live scoring wait up to this
+# many milliseconds to be scored together in one matrix product (0 = off)
+MICROBATCH_WINDOW_MS = float(os.environ.get('MICROBATCH_WINDOW_MS', 0))
+MICROBATCH_MAX_SIZE = int(os.environ.get('MICROBATCH_MAX_SIZE', BATCH_BLOCK_SIZE))
+# 'tfidf' scores songs by sparse TF-IDF cosine; 'svd' by cosine of dense float32 SVD embeddings
+SIMILARITY_MODEL = os.environ.get('SIMILARITY_MODEL', 'tfidf')
+EMBEDDING_DIMS = int(os.environ.get('EMBEDDING_DIMS', 64))
+if SIMILARITY_MODEL not in ('tfidf', 'svd'):
+    raise ValueError(f"SIMILARITY_MODEL must be 'tfidf' or 'svd', not '{SIMILARITY_MODEL}'")
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')  # Admin endpoints are disabled unless set
+CATALOG_WATCH_INTERVAL = float(os.environ.get('CATALOG_WATCH_INTERVAL', 0))  # Seconds; 0 disables watching
+INGEST_MAX_SONGS = 5000
+# Share of the fitted vocabulary that terms unknown to it may reach (across songs
+# ingested since the last fit) before a full refit is scheduled
+INGEST_REFIT_DRIFT = float(os.environ.get('INGEST_REFIT_DRIFT', 0.1))
+
+# The model currently being served. Everything derived from one version of
+# the catalog lives in a single ModelSnapshot, and a reload replaces this one
+# reference, so a request that read it keeps a consistent view until it ends.
+model = None
+# Held while a snapshot is built from another one or from the catalog file,
+# so ingests and reloads are applied one at a time
+model_lock = threading.Lock()
+# Scores concurrent live recommendation queries in shared batches, if enabled
+micro_batcher = MicroBatcher(MICROBATCH_WINDOW_MS / 1000, MICROBATCH_MAX_SIZE) if MICROBATCH_WINDOW_MS > 0 else None
+
+class ModelSnapshot:
+    """Immutable bundle of the song metadata, TF-IDF model and indexes built
+    from one version of the catalog"""
+    
+    def __init__(self, source_digest, songs, tfidf, tfidf_matrix, tfidf_matrix_t, neighbors, indexes, ingested,
+                 ann_index=None, embedding=None, build_timings=None):
+        self.source_digest = source_digest  # SHA-256 of the CSV the snapshot was built from
+        self.songs = songs  # SongStore with the catalog metadata
+        self.tfidf = tfidf
+        self.tfidf_matrix = tfidf_matrix
+        self.tfidf_matrix_t = tfidf_matrix_t  # CSR copy of the transpose, for fast row-times-catalog products
+        # Vectors songs are compared by: the TF-IDF rows, or the SVD embedding in 'svd' mode
+        self.embedding = embedding
+        self.vectors = embedding.vectors if embedding is not None else tfidf_matrix
+        self.vectors_t = transpose_matrix(self.vectors) if embedding is not None else tfidf_matrix_t
+        # Precomputed top-K table (memory-mapped) and its scores, if one is built
+        self.neighbor_indices, self.neighbor_scores = neighbors if neighbors is not None else (None, None)
+        self.ann_index = ann_index  # IVFIndex used instead of exact scoring, if one is built
+        self.facets = indexes['facets']  # {column: Facet} for mood, language, genre and artist_name
+        self.years = indexes['years']
+        self.title_index = indexes['title_index']
+        self.search_index = indexes['search_index']
+        self.suggest_index = indexes['suggest_index']
+        self.audio_features = indexes['audio_features']  # FeatureMatrix, or None if the catalog has no audio features
+        # Songs appended since the model was last fitted, and the terms among
+        # them that the fitted vocabulary does not contain
+        self.ingested_rows = ingested['rows']
+        self.unknown_terms = ingested['unknown_terms']
+        # Responses of get_recommendations(); a new snapshot starts with an empty cache
+        self.recommendation_cache = LRUCache(RECOMMENDATION_CACHE_SIZE, RECOMMENDATION_CACHE_TTL)
+        # Bodies and ETags of responses that only change with the snapshot (facet lists), built on first use
+        self.static_responses = {}
+        self.loaded_at = time.time()
+        self.build_timings = build_timings  # Seconds per build stage, if this process built the model
+    
+    def static_response(self, name, build):
+        """(body, etag) of a response derived only from this snapshot. build()
+        returns its payload; it runs once per snapshot."""
+        cached = self.static_responses.get(name)
+        if cached is None:
+            body = json.dumps(build(), sort_keys=True, separators=(',', ':')) + '\n'
+            etag = f'{self.source_digest[:16]}-{hashlib.sha256(body.encode()).hexdigest()[:16]}'
+            cached = self.static_responses[name] = (body, etag)
+        return cached
+    
+    @property
+    def vocabulary_drift(self):
+        """Unknown terms seen since the last fit, relative to the fitted vocabulary"""
+        return len(self.unknown_terms) / max(len(self.tfidf.idf_), 1)
 
 def load_data():
     """Load and preprocess the music dataset"""
-    global data, tfidf_matrix, cosine_sim, tfidf
+    global model
     
     try:
-        print("Starting data load...")
+        model = load_snapshot(DATA_FILE)
+    except Exception as e:
+        print(f"Error loading data: {str(e)}")
+        raise e
+
+def reload_data(refit=False):
+    """Build a snapshot from the current catalog file and swap it in.
+    The old snapshot keeps serving until the new one is complete. refit
+    discards songs ingested since the last fit by fitting the model again."""
+    global model
+    
+    with model_lock:
+        snapshot = load_snapshot(DATA_FILE, current=None if refit else model, refit=refit)
+        if snapshot is not model:
+            model = snapshot
+            print(f"Swapped in model {snapshot.source_digest[:16]} ({len(snapshot.songs)} songs)")
+    schedule_refit_if_drifted(snapshot)
+
+def schedule_refit_if_drifted(snapshot):
+    """Queue a full refit once ingested songs have brought in too many unknown terms.
+    Returns True if one was scheduled."""
+    if not snapshot.ingested_rows or snapshot.vocabulary_drift <= INGEST_REFIT_DRIFT:
+        return False
+    print(f"Vocabulary drift {snapshot.vocabulary_drift:.3f} exceeds {INGEST_REFIT_DRIFT}, scheduling a refit")
+    reloader.trigger(refit=True)
+    return True
+
+# Runs reload_data() in the background, for the admin endpoint and the file watcher
+reloader = Reloader(reload_data)
+
+@app.before_request
+def start_catalog_watch():
+    """Reload automatically when the catalog file changes, if CATALOG_WATCH_INTERVAL is set.
+    Started from the first request so it runs in each serving process (gunicorn workers
+    are forked after import, and threads do not survive a fork); later calls are no-ops."""
+    if CATALOG_WATCH_INTERVAL > 0:
+        reloader.watch(DATA_FILE, CATALOG_WATCH_INTERVAL)
+
+def load_snapshot(data_file, current=None, refit=False):
+    """Build a ModelSnapshot for the catalog file, reusing the artifact cache when
+    possible. Returns current unchanged if the file has the same contents.
+    With refit, a cached model that had songs ingested into it is not reused."""
+    print("Starting data load...")
+    
+    # Check if data file exists, if not create sample data
+    if not os.path.exists(data_file):
+        print("Data file not found, creating sample data...")
+        create_sample_data()
+    else:
+        print("Data file found, loading existing data...")
+    
+    source_digest = file_digest(data_file)
+    if current is not None and current.source_digest == source_digest:
+        print("Catalog unchanged, keeping the current model")
+        return current
+    
+    def load_cached():
+        cached = load_model(source_digest)
+        if cached is not None and refit and int(cached[3]['ingest']['rows']):
+            return None
+        if (cached is not None and STREAM_CHUNK_ROWS > 0 and SIMILARITY_MODEL == 'svd'
+                and restore_embedding(cached[3]) is None):
+            # Streamed again rather than fitting the embedding on the whole matrix in memory below
+            return None
+        return cached
+    
+    print("Looking for a cached model...")
+    cached = load_cached() if MODEL_CACHE_ENABLED or STREAM_CHUNK_ROWS > 0 else None
+    build_timings = None
+    
+    if cached is None:
+        # Another process may be building the same catalog; wait for it and reuse its result
+        with build_lock() if MODEL_CACHE_ENABLED or STREAM_CHUNK_ROWS > 0 else contextlib.nullcontext():
+            if MODEL_CACHE_ENABLED or STREAM_CHUNK_ROWS > 0:
+                cached = load_cached()
+            if cached is None and STREAM_CHUNK_ROWS > 0:
+                # The streamed model only exists on disk; it is then loaded like a cached one. It
+                # replaces any cached model found unusable (e.g. one without the svd embedding)
+                build_timings = stream_model(data_file, source_digest, replace=True)
+                cached = load_model(source_digest)
+                if cached is None:
+                    raise RuntimeError("The streamed model could not be loaded back")
+            elif cached is None:
+                # Each step reads only the columns it needs from the catalog
+                timer = StageTimer()
+                catalog = Catalog(data_file)
+                with timer.stage('tfidf'):
+                    tfidf, tfidf_matrix, tfidf_matrix_t = build_model(read_columns(catalog, FEATURE_COLUMNS))
+                if SIMILARITY_MODEL == 'svd':
+                    with timer.stage('embedding'):
+                        embedding = Embedding.fit(tfidf_matrix, EMBEDDING_DIMS)
+                else:
+                    embedding = None
+                with timer.stage('songs'):
+                    songs = encode_song_fields(SongStore.from_frame(read_columns(catalog)))
+                with timer.stage('indexes'):
+                    indexes = build_indexes(read_columns(catalog, INDEX_COLUMNS + AUDIO_FEATURE_COLUMNS))
+                del catalog
+                ingested = {'rows': 0, 'unknown_terms': frozenset()}
+                if MODEL_CACHE_ENABLED:
+                    print("Saving model cache...")
+                    try:
+                        with timer.stage('save'):
+                            save_model(source_digest, tfidf, tfidf_matrix, tfidf_matrix_t,
+                                       model_components(songs, indexes, ingested, embedding), replace=refit)
+                    except OSError as e:
+                        print(f"Could not save model cache: {str(e)}")
+                build_timings = timer.timings
+                print(f"Model built ({timer.summary()})")
+    
+    if cached is not None:
+        print("Loaded cached model (memory-mapped)")
+        tfidf, tfidf_matrix, tfidf_matrix_t, components = cached
+        songs = restore_song_store(components['songs'], OPEN_SONG_SHARDS)
+        indexes = restore_indexes(components)
+        ingested = {
+            'rows': int(components['ingest']['rows']),
+            'unknown_terms': frozenset(components['ingest']['unknown_terms'].tolist()),
+        }
+        embedding = restore_embedding(components)
+        if SIMILARITY_MODEL == 'svd' and embedding is None:
+            # Cached in 'tfidf' mode or with other dimensions: add the embedding to the cached model
+            embedding = Embedding.fit(tfidf_matrix, EMBEDDING_DIMS)
+            if MODEL_CACHE_ENABLED:
+                try:
+                    save_model(source_digest, tfidf, tfidf_matrix, tfidf_matrix_t,
+                               model_components(songs, indexes, ingested, embedding), replace=True)
+                except OSError as e:
+                    print(f"Could not save model cache: {str(e)}")
+    
+    print("Loading precomputed neighbors...")
+    neighbors = load_neighbors(source_digest, len(songs), similarity=SIMILARITY_MODEL)
+    # The ANN index clusters TF-IDF vectors; embedding scoring is a dense product instead
+    ann_index = load_ann(source_digest, len(songs)) if embedding is None else None
+    
+    print("Data load completed successfully!")
+    print(f"Data shape: {songs.shape}")
+    print(f"TF-IDF matrix shape: {str(getattr(tfidf_matrix, 'shape', tfidf_matrix))}")
+    print(f"TF-IDF non-zeros: {tfidf_matrix.nnz}")
+    
+    return ModelSnapshot(source_digest, songs, tfidf, tfidf_matrix, tfidf_matrix_t, neighbors, indexes, ingested,
+                         ann_index, embedding, build_timings)
+
+def stream_model(data_file, source_digest, replace=False):
+    """Build the model for a catalog too large to load at once, straight into
+    the artifact cache, reading the file in chunks of STREAM_CHUNK_ROWS rows.
+
+    The TF-IDF matrix and its transpose are written chunk by chunk into
+    memory-mapped files (see stream_build), the song metadata is stored
+    as one shard per chunk that the server maps lazily, and the lookup
+    indexes are built per chunk and merged on disk (write_indexes). In svd
+    mode the embedding is fitted over the on-disk matrix a chunk of rows at
+    a time (write_embedding). Returns the build stage timings."""
+    catalog = Catalog(data_file)
+    timer = StageTimer()
+    
+    def feature_chunks():
+        for frame in catalog.iter_chunks(STREAM_CHUNK_ROWS, FEATURE_COLUMNS):
+            add_default_columns(frame)
+            yield combine_features(frame)
+    
+    def index_chunks():
+        for frame in catalog.iter_chunks(STREAM_CHUNK_ROWS, INDEX_COLUMNS + AUDIO_FEATURE_COLUMNS):
+            add_default_columns(frame)
+            yield frame
+    
+    def write(directory):
+        with timer.stage('vocabulary'):
+            terms, document_frequency, n_rows, nnz = count_terms(feature_chunks())
+        with timer.stage('tfidf'):
+            tfidf = write_tfidf(directory, feature_chunks(), terms, document_frequency, n_rows, nnz)
+            save_vectorizer(directory, tfidf)
         
-        # Check if data file exists, if not create sample data
-        data_file = 'music_data.csv'
-        if not os.path.exists(data_file):
-            print("Data file not found, creating sample data...")
-            create_sample_data()
-        else:
-            print("Data file found, loading existing data...")
-        
-        print("Reading CSV file...")
-        data = pd.read_csv(data_file)
-        print(f"Loaded {len(data)} songs")
-        
-        # Add language column if it doesn't exist (for backward compatibility)
-        if 'language' not in data.columns:
-            print("Adding language column...")
-            data['language'] = 'English'  # Default to English for existing data
-        
-        # Add mood column if it doesn't exist (for backward compatibility)
-        if 'mood' not in data.columns:
-            print("Adding mood column...")
-            data['mood'] = 'Happy'  # Default mood for existing data
-        
-        print("Creating combined features...")
-        # Combine song metadata into a single feature for similarity computation
-        data['combined_features'] = (
-            data['genre'].fillna('') + ' ' +
-            data['artist_name'].fillna('') + ' ' +
-            data['track_name'].fillna('') + ' ' +
-            data['language'].fillna('') + ' ' +
-            data['mood'].fillna('')
-        )
+        with timer.stage('songs'):
+            shard_rows = []
+            for number, frame in enumerate(catalog.iter_chunks(STREAM_CHUNK_ROWS)):
+                add_default_columns(frame)
+                shard = encode_song_fields(SongStore.from_frame(frame))
+                save_arrays(directory, 'songs', nested_arrays(f'shard{number}', shard.arrays()))
+                shard_rows.append(len(shard))
+            if sum(shard_rows) != n_rows:
+                raise ValueError(f"{data_file} changed while the model was built ({sum(shard_rows)} rows, expected {n_rows})")
+            save_arrays(directory, 'songs', {'names': np.array(shard.names, dtype=str),
+                                             'shard_rows': np.array(shard_rows, dtype=np.int64)})
+        
+        with timer.stage('indexes'):
+            names = write_indexes(directory, index_chunks(), n_rows, FACET_COLUMNS + ['artist_name'],
+                                  SUGGEST_MAX_LIMIT)
+            save_arrays(directory, 'ingest', ingest_arrays({'rows': 0, 'unknown_terms': frozenset()}))
         
+        if SIMILARITY_MODEL == 'svd':
+            with timer.stage('embedding'):
+                write_embedding(directory, load_csr(directory, 'tfidf', (n_rows, len(terms))), EMBEDDING_DIMS,
+                                STREAM_CHUNK_ROWS)
+                save_arrays(directory, 'embedding', {'requested_dims': np.array(EMBEDDING_DIMS)})
+            names.append('embedding')
+        
+        return (n_rows, len(terms)), nnz, ['songs', 'ingest', *names]
+    
+    print(f"Streaming model build in chunks of {STREAM_CHUNK_ROWS} rows...")
+    write_model(source_digest, write, replace=replace)
+    print(f"Model built ({timer.summary()})")
+    return timer.timings
+
+def read_columns(catalog, columns=None):
+    """Some (or all) catalog columns, with defaults for columns older catalogs lack"""
+    print(f"Reading {'all' if columns is None else ', '.join(columns)} columns from {catalog.path}...")
+    data = catalog.read(columns)
+    add_default_columns(data)
+    return data
+
+def build_model(data):
+    """Fit the TF-IDF model on the feature columns of the catalog.
+    Returns (tfidf, tfidf_matrix, tfidf_matrix_t)."""
+    print(f"Loaded {len(data)} songs")
+    
+    print("Creating combined features...")
+    combined_features = combine_features(data)
+    
+    if BUILD_WORKERS > 1:
+        print(f"Creating TF-IDF matrix with {BUILD_WORKERS} worker processes...")
+        tfidf, tfidf_matrix = fit_tfidf(combined_features, BUILD_WORKERS)
+    else:
         print("Creating TF-IDF matrix...")
         # Create TF-IDF matrix
         tfidf = TfidfVectorizer(stop_words='english')
-        tfidf_matrix = tfidf.fit_transform(data['combined_features'])
+        tfidf_matrix = tfidf.fit_transform(combined_features)
+    # Rows are kept L2-normalized so similarities are computed per request
+    # with a sparse dot product instead of a precomputed N x N matrix
+    tfidf_matrix = prepare_matrix(tfidf_matrix)
+    tfidf_matrix_t = transpose_matrix(tfidf_matrix)
+    
+    return tfidf, tfidf_matrix, tfidf_matrix_t
+
+def add_default_columns(data):
+    """Add the language and mood columns older catalogs lack (for backward compatibility)"""
+    if 'language' not in data.columns:
+        print("Adding language column...")
+        data['language'] = 'English'  # Default to English for existing data
+    
+    if 'mood' not in data.columns:
+        print("Adding mood column...")
+        data['mood'] = 'Happy'  # Default mood for existing data
+
+def combine_features(data):
+    """Song metadata joined into the single text feature used for similarity.
+    It only feeds the vectorizer, so it is not kept with the song metadata."""
+    return (
+        text_values(data['genre']) + ' ' +
+        text_values(data['artist_name']) + ' ' +
+        text_values(data['track_name']) + ' ' +
+        text_values(data['language']) + ' ' +
+        text_values(data['mood'])
+    )
+
+def build_indexes(data):
+    """Build the lookup structures derived from the song metadata"""
+    print("Building title index...")
+    title_trigrams = TrigramIndex.build(text_values(data['track_name']))
+    artist_trigrams = TrigramIndex.build(text_values(data['artist_name']))
+    title_index = TitleIndex.build(title_trigrams, artist_trigrams.texts)
+    
+    print("Building facets...")
+    facets = build_facets(data, FACET_COLUMNS + ['artist_name'])
+    years = build_year_array(data)
+    
+    print("Building suggestion index...")
+    suggest_index = PrefixIndex.build(text_values(data['track_name']), text_values(data['artist_name']), years,
+                                      max_suggestions=SUGGEST_MAX_LIMIT)
+    
+    audio_features = FeatureMatrix.build(data)
+    if audio_features is not None:
+        print(f"Standardized {len(audio_features.columns)} audio feature columns")
+    
+    return {
+        'title_trigrams': title_trigrams,
+        'artist_trigrams': artist_trigrams,
+        'title_index': title_index,
+        'search_index': SearchIndex(title_trigrams, artist_trigrams),
+        'suggest_index': suggest_index,
+        'facets': facets,
+        'years': years,
+        'audio_features': audio_features,
+    }
+
+def encode_song_fields(songs):
+    """Pre-encode every song for the field sets responses return: whole rows
+    for recommendations, SONG_FIELDS for search and the song list"""
+    songs = songs.with_fragments()
+    if set(SONG_FIELDS) <= set(songs.names):
+        songs = songs.with_fragments(SONG_FIELDS)
+    return songs
+
+def model_components(songs, indexes, ingested, embedding=None):
+    """Song metadata, indexes and ingest state as name -> dict of arrays, for the model cache"""
+    return {'songs': songs.arrays(), **index_components(indexes, ingested, embedding)}
+
+def index_components(indexes, ingested, embedding=None):
+    """model_components() without the songs"""
+    components = {
+        'ingest': ingest_arrays(ingested),
+        'title_trigrams': indexes['title_trigrams'].arrays(),
+        'artist_trigrams': indexes['artist_trigrams'].arrays(),
+        'title_index': indexes['title_index'].arrays(),
+        'suggest_index': indexes['suggest_index'].arrays(),
+        'years': {'years': indexes['years']},
+    }
+    for column, facet in indexes['facets'].items():
+        components[f'facet_{column}'] = facet.arrays()
+    if indexes['audio_features'] is not None:
+        components['audio_features'] = indexes['audio_features'].arrays()
+    if embedding is not None:
+        components['embedding'] = {**embedding.arrays(), 'requested_dims': np.array(EMBEDDING_DIMS)}
+    return components
+
+def ingest_arrays(ingested):
+    """Ingest state (rows added since the last full build, terms outside the vocabulary) as arrays"""
+    return {
+        'rows': np.array(ingested['rows']),
+        'unknown_terms': np.array(sorted(ingested['unknown_terms']), dtype=str),
+    }
+
+def restore_embedding(components):
+    """The cached SVD embedding, or None if there is none for the configured dimensions"""
+    arrays = components.get('embedding')
+    if SIMILARITY_MODEL != 'svd' or arrays is None or int(arrays['requested_dims']) != EMBEDDING_DIMS:
+        return None
+    return Embedding.from_arrays(arrays)
+
+def restore_indexes(components):
+    """Inverse of model_components for everything but the songs"""
+    title_trigrams = TrigramIndex.from_arrays(components['title_trigrams'])
+    artist_trigrams = TrigramIndex.from_arrays(components['artist_trigrams'])
+    return {
+        'title_trigrams': title_trigrams,
+        'artist_trigrams': artist_trigrams,
+        'title_index': TitleIndex.from_arrays(components['title_index'], title_trigrams, artist_trigrams.texts),
+        'search_index': SearchIndex(title_trigrams, artist_trigrams),
+        'suggest_index': PrefixIndex.from_arrays(components['suggest_index']),
+        'facets': {name[len('facet_'):]: Facet.from_arrays(arrays)
+                   for name, arrays in components.items() if name.startswith('facet_')},
+        'years': components['years']['years'],
+        'audio_features': FeatureMatrix.from_arrays(components['audio_features'])
+                          if 'audio_features' in components else None,
+    }
+
+def append_indexes(current, frame):
+    """The indexes of a snapshot extended with the songs in frame"""
+    title_trigrams = current.title_index.substrings.append(text_values(frame['track_name']))
+    artist_trigrams = current.search_index.artists.append(text_values(frame['artist_name']))
+    new_years = build_year_array(frame)
+    
+    return {
+        'title_trigrams': title_trigrams,
+        'artist_trigrams': artist_trigrams,
+        'title_index': current.title_index.append(title_trigrams, artist_trigrams.texts),
+        'search_index': SearchIndex(title_trigrams, artist_trigrams),
+        'suggest_index': current.suggest_index.append(text_values(frame['track_name']),
+                                                      text_values(frame['artist_name']), new_years),
+        'facets': {column: facet.append(frame[column]) for column, facet in current.facets.items()},
+        'years': np.concatenate([current.years, new_years]),
+        'audio_features': current.audio_features.append(frame) if current.audio_features is not None else None,
+    }
+
+def ingest_songs(records):
+    """Append songs to the catalog without refitting the model.
+    
+    New songs are vectorized with the fitted vocabulary and IDF and appended to
+    the TF-IDF matrix (and embedding), the song store and every index; in the neighbor table only
+    the lists the new songs enter are merged. The songs are also appended to the
+    catalog, and the result is saved to the artifact cache under its new hash,
+    so other workers and restarts load it instead of rebuilding. Terms the
+    vocabulary lacks are dropped from the new rows; once they add up to
+    INGEST_REFIT_DRIFT of the vocabulary a full refit is scheduled.
+    
+    The build lock is held throughout, as other processes (gunicorn workers)
+    ingest into the same catalog and artifact cache."""
+    global model
+    
+    with model_lock, build_lock():
+        current = model
+        if current is None:
+            return {"error": "Data not loaded"}
         
-        print("Calculating cosine similarity...")
-        # Calculate cosine similarity
-        cosine_sim = cosine_similarity(tfidf_matrix, tfidf_matrix)
+        if file_digest(DATA_FILE) != current.source_digest:
+            # Another process changed the catalog since this snapshot was built;
+            # append to the model of the catalog as it is now
+            print("Catalog changed since the model was loaded, reloading it before ingesting")
+            current = model = load_snapshot(DATA_FILE, current=current)
         
-        print("Data load completed successfully!")
-        print(f"Data shape: {data.shape}")
-        print(f"TF-IDF matrix shape: {str(getattr(tfidf_matrix, 'shape', tfidf_matrix))}")
-        print(f"Cosine similarity matrix shape: {str(getattr(cosine_sim, 'shape', cosine_sim))}")
+        frame = pd.DataFrame.from_records(records)
+        add_default_columns(frame)
+        for column in SONG_FIELDS:
+            if column not in frame.columns:
+                frame[column] = None
+        # Nullable integers, so a missing year does not turn the others into floats in the CSV
+        frame['year'] = pd.to_numeric(frame['year'], errors='coerce').astype('Int64')
         
-    except Exception as e:
-        print(f"Error loading data: {str(e)}")
-        raise e
+        features = combine_features(frame)
+        tail = prepare_matrix(current.tfidf.transform(features))
+        analyzer = current.tfidf.build_analyzer()
+        unknown = {term for text in features for term in analyzer(text) if term not in current.tfidf.vocabulary_}
+        
+        first_row = len(current.songs)
+        tfidf_matrix = sparse.vstack([current.tfidf_matrix, tail], format='csr')
+        tfidf_matrix_t = transpose_matrix(tfidf_matrix)
+        songs = current.songs.append(frame)
+        indexes = append_indexes(current, frame)
+        ingested = {'rows': current.ingested_rows + len(frame), 'unknown_terms': current.unknown_terms | unknown}
+        embedding = current.embedding.append(tail) if current.embedding is not None else None
+        
+        neighbors = None
+        changed_lists = 0
+        if current.neighbor_indices is not None:
+            vectors = embedding.vectors if embedding is not None else tfidf_matrix
+            vectors_t = transpose_matrix(vectors) if embedding is not None else tfidf_matrix_t
+            indices, scores, changed_lists = append_neighbors(current.neighbor_indices, current.neighbor_scores,
+                                                              vectors, vectors_t, first_row)
+            neighbors = (indices, scores)
+        ann_index = None
+        if current.ann_index is not None:
+            ann_index = current.ann_index.append(tail, first_row)
+        
+        # Everything that can fail has been built; now record the songs in the catalog
+        Catalog(DATA_FILE).append(frame)
+        source_digest = file_digest(DATA_FILE)
+        if neighbors is not None:
+            save_neighbors(neighbors[0], neighbors[1], DATA_FILE, similarity=SIMILARITY_MODEL)
+        if ann_index is not None:
+            save_ann(ann_index, DATA_FILE)
+        
+        snapshot = ModelSnapshot(source_digest, songs, current.tfidf, tfidf_matrix, tfidf_matrix_t,
+                                 neighbors, indexes, ingested, ann_index, embedding)
+        if MODEL_CACHE_ENABLED:
+            try:
+                save_model(source_digest, current.tfidf, tfidf_matrix, tfidf_matrix_t,
+                           model_components(songs, indexes, ingested, embedding))
+                # Serve the saved copy: memory-mapped files are shared with other workers
+                snapshot = load_snapshot(DATA_FILE)
+            except OSError as e:
+                print(f"Could not save model cache: {str(e)}")
+        
+        model = snapshot
+        print(f"Ingested {len(frame)} songs ({len(unknown)} unknown terms, {changed_lists} neighbor lists updated)")
+    
+    refit_scheduled = schedule_refit_if_drifted(snapshot)
+    return {
+        "added": len(frame),
+        "total_songs": len(snapshot.songs),
+        "unknown_terms": sorted(unknown),
+        "neighbor_lists_updated": changed_lists,
+        "ingested_since_fit": snapshot.ingested_rows,
+        "vocabulary_drift": snapshot.vocabulary_drift,
+        "refit_scheduled": refit_scheduled,
+    }
 
 def create_sample_data():
     """Create sample music data if the dataset doesn't exist"""
@@ -153,59 +679,228 @@ def create_sample_data():
     }
     
     df = pd.DataFrame(sample_data)
-    df.to_csv('music_data.csv', index=False)
+    write_catalog(df, DATA_FILE)
 
-def get_recommendations(song_title, top_n=10, mood_filter=None):
-    """Get music recommendations based on song title with optional mood filtering"""
-    global data, cosine_sim
+def get_recommendations(song_title, top_n=10, mood_filter=None, language_filter=None,
+                        genre_filter=None, year_min=None, year_max=None, artist_name=None,
+                        feature_weight=0, feature_target=None):
+    """Get music recommendations based on song title with optional mood, language,
+    genre and year range filtering. artist_name picks between tracks sharing a title.
+    feature_weight blends in audio-feature similarity to the song (or to
+    feature_target values, if given)."""
+    current = model  # One snapshot for the whole request, even if a reload swaps it meanwhile
     
-    print(f"get_recommendations called with: song_title={song_title}, top_n={top_n}, mood_filter={mood_filter}")
-    print(f"data is None: {data is None}")
-    print(f"cosine_sim is None: {cosine_sim is None}")
+    print(f"get_recommendations called with: song_title={song_title}, artist_name={artist_name}, top_n={top_n}, "
+          f"mood_filter={mood_filter}, language_filter={language_filter}, genre_filter={genre_filter}, "
+          f"year_min={year_min}, year_max={year_max}")
+    print(f"model is None: {current is None}")
     
-    if data is None or cosine_sim is None:
+    if current is None:
         print("Data not loaded, returning error")
         return {"error": "Data not loaded"}
     
-    # Get the index of the song that matches the title
-    idx = data[data['track_name'].str.lower() == song_title.lower()].index
+    cache_key = (
+        normalize_text(song_title),
+        normalize_text(artist_name) if artist_name else '',
+        top_n,
+        normalize_value(mood_filter) if mood_filter else '',
+        normalize_value(language_filter) if language_filter else '',
+        normalize_value(genre_filter) if genre_filter else '',
+        year_min,
+        year_max,
+        feature_weight,
+        tuple(sorted(feature_target.items())) if feature_target else None,
+    )
+    cached = current.recommendation_cache.get(cache_key)
+    if cached is not None:
+        return cached
     
-    if len(idx) == 0:
-        # Try partial matching
-        idx = data[data['track_name'].str.lower().str.contains(song_title.lower())].index
+    # Get the index of the song that matches the title (exact, then partial)
+    idx = current.title_index.lookup(song_title, artist_name)
     
-    if len(idx) == 0:
+    if idx is None:
         return {"error": "Song not found in the dataset"}
     
-    idx = idx[0]
+    # Rows allowed by the filters; applied before truncating to top_n
+    mask = recommendation_mask(current, mood_filter, language_filter, genre_filter, year_min, year_max)
+    
+    feature_query = None
+    if feature_weight > 0:
+        feature_query, error = audio_feature_query(current, [idx], None, feature_target)
+        if error:
+            return {"error": error}
+    
+    song_indices = None
+    if feature_query is None:
+        # The neighbor table and ANN index rank by text similarity alone
+        song_indices = neighbor_recommendations(current, idx, top_n, mask)
+        if song_indices is None and current.ann_index is not None:
+            song_indices = current.ann_index.search(current.tfidf_matrix, current.tfidf_matrix[idx], top_n,
+                                                    ANN_NPROBE, exclude=idx, mask=mask)
+    
+    if song_indices is None:
+        # Get similarity scores for all songs
+        if micro_batcher is not None:
+            sim_scores = micro_batcher.score(current.vectors, current.vectors_t, idx)
+        else:
+            sim_scores = score_row(current.vectors, current.vectors_t, idx)
+        if feature_query is not None:
+            sim_scores = blend_scores(sim_scores, current.audio_features, feature_query, feature_weight)
+        
+        # Get top N most similar matching songs, excluding the song itself by index
+        song_indices = top_k(sim_scores, top_n, exclude=idx, mask=mask)
+    
+    # Return recommended songs, already encoded as JSON
+    recommendations = current.songs.encoded_rows(song_indices)
+    current.recommendation_cache.put(cache_key, recommendations)
+    
+    return recommendations
+
+def recommendation_mask(snapshot, mood_filter=None, language_filter=None, genre_filter=None,
+                        year_min=None, year_max=None):
+    """Boolean mask of rows allowed by the recommendation filters, or None"""
+    return filter_mask(snapshot.facets, snapshot.years, mood=mood_filter, language=language_filter,
+                       genre=genre_filter, year_min=year_min, year_max=year_max)
+
+def check_blend(snapshot, blend):
+    """Error message if the snapshot's catalog cannot blend audio features as
+    requested (it has none, or feature_target names unknown ones), else None"""
+    if snapshot is None or (blend['feature_weight'] <= 0 and not blend['feature_target']):
+        return None
+    if snapshot.audio_features is None:
+        return (f"This catalog has no audio features to blend "
+                f"(supported columns: {', '.join(AUDIO_FEATURE_COLUMNS)})")
+    columns = snapshot.audio_features.columns
+    unknown = [name for name in blend['feature_target'] or () if name not in columns]
+    if unknown:
+        return f"Unknown audio features: {', '.join(unknown)} (valid: {', '.join(columns)})"
+    return None
+
+def audio_feature_query(snapshot, rows, weights=None, target=None):
+    """(query vector, error) for blending audio-feature similarity: the seeds'
+    standardized profile, or the target values when given"""
+    error = check_blend(snapshot, {'feature_weight': 1, 'feature_target': target})
+    if error:
+        return None, error
+    if target:
+        return snapshot.audio_features.target(target), None
+    return snapshot.audio_features.profile(rows, weights), None
+
+def neighbor_recommendations(snapshot, idx, top_n, mask):
+    """Top N rows from the precomputed neighbor table, or None if it cannot answer"""
+    if snapshot.neighbor_indices is None:
+        return None
+    
+    # O(K) slice of the precomputed neighbor table (the song itself is not stored)
+    candidates = np.asarray(snapshot.neighbor_indices[idx])
+    if mask is not None:
+        candidates = candidates[mask[candidates]]
+    if top_n > len(candidates):
+        return None
+    return candidates[:top_n]
+
+def get_batch_recommendations(seeds):
+    """Recommendations for several seeds at once. Seeds the neighbor table cannot
+    answer are scored together, one sparse matrix product per block of seeds."""
+    current = model
+    
+    if current is None:
+        return {"error": "Data not loaded"}
+    
+    results = [None] * len(seeds)
+    pending = []  # (position, seed row, top_n, mask, feature blend) still needing live scoring
     
-    # Get similarity scores for all songs
-    sim_scores = list(enumerate(cosine_sim[idx]))
+    for position, seed in enumerate(seeds):
+        idx = current.title_index.lookup(seed['song_title'], seed['artist_name'])
+        if idx is None:
+            results[position] = {"error": "Song not found in the dataset"}
+            continue
+        
+        mask = recommendation_mask(current, **seed['filters'])
+        blend = None
+        if seed['blend']['feature_weight'] > 0:
+            feature_query, error = audio_feature_query(current, [idx], None, seed['blend']['feature_target'])
+            if error:
+                results[position] = {"error": error}
+                continue
+            blend = (feature_query, seed['blend']['feature_weight'])
+            song_indices = None
+        else:
+            song_indices = neighbor_recommendations(current, idx, seed['top_n'], mask)
+            if song_indices is None and current.ann_index is not None:
+                song_indices = current.ann_index.search(current.tfidf_matrix, current.tfidf_matrix[idx], seed['top_n'],
+                                                        ANN_NPROBE, exclude=idx, mask=mask)
+        if song_indices is None:
+            pending.append((position, idx, seed['top_n'], mask, blend))
+        else:
+            results[position] = current.songs.encoded_rows(song_indices)
+    
+    for start in range(0, len(pending), BATCH_BLOCK_SIZE):
+        block = pending[start:start + BATCH_BLOCK_SIZE]
+        block_scores = score_rows(current.vectors, current.vectors_t, [idx for _, idx, _, _, _ in block])
+        for (position, idx, top_n, mask, blend), sim_scores in zip(block, block_scores):
+            if blend is not None:
+                sim_scores = blend_scores(sim_scores, current.audio_features, *blend)
+            song_indices = top_k(sim_scores, top_n, exclude=idx, mask=mask)
+            results[position] = current.songs.encoded_rows(song_indices)
+    
+    return results
+
+def get_playlist_recommendations(seeds, top_n=10, mood_filter=None, language_filter=None,
+                                 genre_filter=None, year_min=None, year_max=None,
+                                 feature_weight=0, feature_target=None):
+    """Recommendations for a set of seed songs as a whole. The seeds' TF-IDF rows
+    are combined into one weighted centroid, the catalog is scored once, and every
+    seed is excluded from the results. feature_weight blends in similarity to the
+    seeds' mean audio-feature profile (or to feature_target values)."""
+    current = model
     
-    # Sort songs based on similarity scores
-    sim_scores = sorted(sim_scores, key=lambda x: x[1], reverse=True)
+    if current is None:
+        return {"error": "Data not loaded"}
+    
+    rows, weights, missing = [], [], []
+    for seed in seeds:
+        idx = current.title_index.lookup(seed['song_title'], seed['artist_name'])
+        if idx is None:
+            missing.append(seed['song_title'])
+        else:
+            rows.append(idx)
+            weights.append(seed['weight'])
     
-    # Get top N most similar songs
-    sim_scores = sim_scores[1:top_n+1]  # Exclude the song itself
-    song_indices = [i[0] for i in sim_scores]
+    if not rows:
+        return {"error": "None of the seed songs were found in the dataset", "missing_seeds": missing}
     
-    # Return recommended songs
-    recommendations = data.iloc[song_indices]
+    mask = recommendation_mask(current, mood_filter, language_filter, genre_filter, year_min, year_max)
+    feature_query = None
+    if feature_weight > 0:
+        feature_query, error = audio_feature_query(current, rows, weights, feature_target)
+        if error:
+            return {"error": error}
     
-    # Apply mood filter if specified
-    if mood_filter:
-        recommendations = recommendations[recommendations['mood'].str.lower() == mood_filter.lower()]
+    query = centroid_query(current.vectors, rows, weights)
+    song_indices = None
+    if current.ann_index is not None and feature_query is None:
+        song_indices = current.ann_index.search(current.tfidf_matrix, query, top_n, ANN_NPROBE, exclude=rows, mask=mask)
+    if song_indices is None:
+        sim_scores = score_query(query, current.vectors_t)
+        if feature_query is not None:
+            sim_scores = blend_scores(sim_scores, current.audio_features, feature_query, feature_weight)
+        song_indices = top_k(sim_scores, top_n, exclude=rows, mask=mask)
     
-    return recommendations.to_dict(orient='records')
+    return {
+        "seeds": current.songs.column_values('track_name', sorted(set(rows))),
+        "missing_seeds": missing,
+        "recommendations": current.songs.encoded_rows(song_indices)
+    }
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    global data, cosine_sim
+    current = model
     
     status = "healthy"
     message = "Music Recommendation API is running"
-    data_loaded = data is not None and cosine_sim is not None
+    data_loaded = current is not None
     
     if not data_loaded:
         status = "unhealthy"
@@ -215,18 +910,130 @@ def health_check():
         "status": status, 
         "message": message,
         "data_loaded": data_loaded,
-        "data_shape": data.shape if data is not None else None,
-        "cosine_sim_shape": cosine_sim.shape if cosine_sim is not None else None
+        "data_shape": current.songs.shape if data_loaded else None,
+        "tfidf_matrix_shape": current.tfidf_matrix.shape if data_loaded else None,
+        "tfidf_matrix_nnz": current.tfidf_matrix.nnz if data_loaded else None,
+        "neighbors_k": current.neighbor_indices.shape[1] if data_loaded and current.neighbor_indices is not None else None,
+        "ann_lists": current.ann_index.n_lists if data_loaded and current.ann_index is not None else None,
+        "ann_nprobe": ANN_NPROBE,
+        "similarity_model": SIMILARITY_MODEL,
+        "embedding_dims": current.embedding.dims if data_loaded and current.embedding is not None else None,
+        "audio_features": current.audio_features.columns if data_loaded and current.audio_features is not None else None,
+        "model_digest": current.source_digest[:16] if data_loaded else None,
+        "model_loaded_at": current.loaded_at if data_loaded else None,
+        "build_timings": current.build_timings if data_loaded else None,
+        "ingested_since_fit": current.ingested_rows if data_loaded else None,
+        "vocabulary_drift": current.vocabulary_drift if data_loaded else None,
+        "recommendation_cache": current.recommendation_cache.stats() if data_loaded else None,
+        "micro_batching": micro_batcher.stats() if micro_batcher is not None else None,
+        "reload": reloader.status()
     })
 
 @app.route('/api/songs', methods=['GET'])
 def get_all_songs():
-    """Get all songs in the dataset"""
-    if data is None:
+    """List songs in catalog order. With limit, one page is returned along with
+    a cursor for the next one; without it, every song from offset on is
+    streamed. format=ndjson streams one song per line instead."""
+    try:
+        offset = int(request.args.get('cursor', request.args.get('offset', 0)))
+        limit = request.args.get('limit', '')
+        limit = int(limit) if limit != '' else None
+    except ValueError:
+        return jsonify({"error": "limit, offset and cursor must be integers"}), 400
+    
+    if offset < 0 or (limit is not None and limit < 1):
+        return jsonify({"error": "limit must be positive and offset non-negative"}), 400
+    
+    current = model
+    if current is None:
         return jsonify({"error": "Data not loaded"}), 500
+    
+    songs = current.songs
+    fields = SONG_FIELDS
+    if request.args.get('fields'):
+        fields = [field.strip() for field in request.args['fields'].split(',') if field.strip()]
+        unknown = [field for field in fields if field not in songs.names]
+        if unknown or not fields:
+            return jsonify({"error": f"Unknown fields: {', '.join(unknown)}" if unknown else "fields is empty"}), 400
+    
+    start = min(offset, len(songs))
+    ndjson = request.args.get('format') == 'ndjson'
+    if limit is None or ndjson:
+        stop = len(songs) if limit is None else min(start + limit, len(songs))
+        # Streamed from the snapshot taken above, so a reload mid-stream does not mix catalogs
+        if ndjson:
+            return app.response_class(stream_songs(songs, start, stop, fields, ndjson=True),
+                                      mimetype='application/x-ndjson')
+        return app.response_class(stream_songs(songs, start, stop, fields), mimetype=app.json.mimetype)
+    
+    stop = min(start + min(limit, SONGS_MAX_LIMIT), len(songs))
+    return json_response({
+        "songs": songs.encoded_rows(range(start, stop), fields),
+        "total": len(songs),
+        "limit": min(limit, SONGS_MAX_LIMIT),
+        "offset": start,
+        # Songs are only ever appended, so a cursor stays valid across ingests
+        "next_cursor": str(stop) if stop < len(songs) else None
+    })
+
+def stream_songs(songs, start, stop, fields, ndjson=False):
+    """Response chunks for rows start..stop, encoded SONGS_STREAM_BATCH rows at a
+    time so memory does not grow with the catalog. Without ndjson the chunks
+    make up the same {"songs": [...]} body jsonify would produce."""
+    if not ndjson:
+        yield '{"songs":['
+    for batch_start in range(start, stop, SONGS_STREAM_BATCH):
+        rows = range(batch_start, min(batch_start + SONGS_STREAM_BATCH, stop))
+        fragments = songs.encoded_rows(rows, fields).fragments
+        if ndjson:
+            yield ''.join(fragment + '\n' for fragment in fragments)
+        else:
+            yield (',' if batch_start > start else '') + ','.join(fragments)
+    if not ndjson:
+        yield ']}\n'
+
+def json_response(payload, status=200):
+    """Like jsonify, but song rows in the payload (EncodedRows) are copied
+    into the body from their pre-encoded JSON instead of re-serialized"""
+    return app.response_class(encode_response(payload) + '\n', status=status, mimetype=app.json.mimetype)
+
+def parse_filters(request_data):
+    """Read optional recommendation filters from a request body"""
+    filters = {
+        'mood_filter': request_data.get('mood_filter', None),
+        'language_filter': request_data.get('language_filter', None),
+        'genre_filter': request_data.get('genre_filter', None),
+    }
+    for key in ('year_min', 'year_max'):
+        value = request_data.get(key, None)
+        if value is None or value == '':
+            filters[key] = None
+            continue
+        try:
+            filters[key] = int(value)
+        except (TypeError, ValueError):
+            return None, f"{key} must be an integer"
+    return filters, None
+
+def parse_top_n(value):
+    """Validate the number of recommendations requested"""
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        return None, "top_n must be a positive integer"
+    return value, None
 
-    songs = data.loc[:, ['track_name', 'artist_name', 'genre', 'year', 'language', 'mood']].to_dict('records')
-    return jsonify({"songs": songs})
+def parse_blend(request_data):
+    """Read the optional audio-feature blend from a request body: feature_weight
+    (0 = text similarity only, 1 = audio features only) and feature_target, raw
+    feature values to aim for instead of the seed's own (weight 0.5 if not given)"""
+    target = request_data.get('feature_target', None)
+    weight = request_data.get('feature_weight', 0.5 if target else 0)
+    if isinstance(weight, bool) or not isinstance(weight, (int, float)) or not 0 <= weight <= 1:
+        return None, "feature_weight must be a number between 0 and 1"
+    if target is not None:
+        if not isinstance(target, dict) or not all(
+                isinstance(value, (int, float)) and not isinstance(value, bool) for value in target.values()):
+            return None, "feature_target must map audio feature names to numbers"
+    return {'feature_weight': float(weight), 'feature_target': target or None}, None
 
 @app.route('/api/recommendations', methods=['POST'])
 def get_song_recommendations():
@@ -235,17 +1042,24 @@ def get_song_recommendations():
         print("Received recommendation request")
         request_data = request.get_json()
         song_title = request_data.get('song_title', '')
-        top_n = request_data.get('top_n', 10)
-        mood_filter = request_data.get('mood_filter', None)
+        top_n, top_n_error = parse_top_n(request_data.get('top_n', 10))
+        artist_name = request_data.get('artist_name', None)
+        filters, error = parse_filters(request_data)
+        blend, blend_error = parse_blend(request_data)
         
         print(f"Searching for: {song_title}")
         
         if not song_title:
             return jsonify({"error": "Song title is required"}), 400
         
-        recommendations = get_recommendations(song_title, top_n, mood_filter)
+        if not (error or blend_error):
+            blend_error = check_blend(model, blend)
+        if error or blend_error or top_n_error:
+            return jsonify({"error": error or blend_error or top_n_error}), 400
         
-        print(f"Found {len(recommendations) if isinstance(recommendations, list) else 0} recommendations")
+        recommendations = get_recommendations(song_title, top_n, artist_name=artist_name, **filters, **blend)
+        
+        print(f"Found {len(recommendations) if isinstance(recommendations, EncodedRows) else 0} recommendations")
         
         if isinstance(recommendations, dict) and "error" in recommendations:
             print(f"Error: {recommendations['error']}")
@@ -256,7 +1070,131 @@ def get_song_recommendations():
             "recommendations": recommendations
         }
         print(f"Returning {len(recommendations)} recommendations")
-        return jsonify(response_data)
+        return json_response(response_data)
+    
+    except Exception as e:
+        print(f"Exception: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/recommendations/batch', methods=['POST'])
+def get_batch_song_recommendations():
+    """Get song recommendations for many input songs in one request"""
+    try:
+        request_data = request.get_json()
+        raw_seeds = request_data.get('seeds', [])
+        default_top_n, error = parse_top_n(request_data.get('top_n', 10))
+        if not error:
+            _, error = parse_filters(request_data)
+        if not error:
+            _, error = parse_blend(request_data)
+        
+        if error:
+            return jsonify({"error": error}), 400
+        
+        # Top-level filters and blend settings are defaults for every seed, like top_n
+        seed_defaults = {key: request_data[key] for key in BATCH_SEED_DEFAULTS if key in request_data}
+        
+        if not isinstance(raw_seeds, list) or not raw_seeds:
+            return jsonify({"error": "seeds must be a non-empty list"}), 400
+        
+        if len(raw_seeds) > BATCH_MAX_SEEDS:
+            return jsonify({"error": f"At most {BATCH_MAX_SEEDS} seeds per request"}), 400
+        
+        print(f"Received batch recommendation request for {len(raw_seeds)} seeds")
+        
+        seeds = []
+        for position, raw_seed in enumerate(raw_seeds):
+            # A seed is either a title or an object with the single-request fields
+            if isinstance(raw_seed, str):
+                raw_seed = {'song_title': raw_seed}
+            if not isinstance(raw_seed, dict) or not raw_seed.get('song_title'):
+                return jsonify({"error": f"Seed {position}: song title is required"}), 400
+            
+            options = {**seed_defaults, **raw_seed}
+            filters, error = parse_filters(options)
+            blend, blend_error = parse_blend(options)
+            top_n, top_n_error = parse_top_n(raw_seed.get('top_n', default_top_n))
+            if not (error or blend_error):
+                blend_error = check_blend(model, blend)
+            if error or blend_error or top_n_error:
+                return jsonify({"error": f"Seed {position}: {error or blend_error or top_n_error}"}), 400
+            
+            seeds.append({
+                'song_title': raw_seed['song_title'],
+                'artist_name': raw_seed.get('artist_name', None),
+                'top_n': top_n,
+                'filters': filters,
+                'blend': blend,
+            })
+        
+        results = get_batch_recommendations(seeds)
+        
+        if isinstance(results, dict) and "error" in results:
+            return jsonify(results), 500
+        
+        response_data = []
+        for seed, recommendations in zip(seeds, results):
+            if isinstance(recommendations, dict):
+                response_data.append({"query_song": seed['song_title'], **recommendations})
+            else:
+                response_data.append({"query_song": seed['song_title'], "recommendations": recommendations})
+        return json_response({"results": response_data})
+    
+    except Exception as e:
+        print(f"Exception: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/recommendations/playlist', methods=['POST'])
+def get_playlist_song_recommendations():
+    """Get song recommendations for a playlist of seed songs taken together"""
+    try:
+        request_data = request.get_json()
+        raw_seeds = request_data.get('seeds', [])
+        top_n, top_n_error = parse_top_n(request_data.get('top_n', 10))
+        filters, error = parse_filters(request_data)
+        blend, blend_error = parse_blend(request_data)
+        
+        if not (error or blend_error):
+            blend_error = check_blend(model, blend)
+        if error or blend_error or top_n_error:
+            return jsonify({"error": error or blend_error or top_n_error}), 400
+        
+        if not isinstance(raw_seeds, list) or not raw_seeds:
+            return jsonify({"error": "seeds must be a non-empty list"}), 400
+        
+        if len(raw_seeds) > PLAYLIST_MAX_SEEDS:
+            return jsonify({"error": f"At most {PLAYLIST_MAX_SEEDS} seeds per request"}), 400
+        
+        print(f"Received playlist recommendation request for {len(raw_seeds)} seeds")
+        
+        seeds = []
+        for position, raw_seed in enumerate(raw_seeds):
+            # A seed is either a title or an object with song_title, artist_name and weight
+            if isinstance(raw_seed, str):
+                raw_seed = {'song_title': raw_seed}
+            if not isinstance(raw_seed, dict) or not raw_seed.get('song_title'):
+                return jsonify({"error": f"Seed {position}: song title is required"}), 400
+            
+            weight = raw_seed.get('weight', 1.0)
+            if isinstance(weight, bool) or not isinstance(weight, (int, float)) or weight < 0:
+                return jsonify({"error": f"Seed {position}: weight must be a non-negative number"}), 400
+            
+            seeds.append({
+                'song_title': raw_seed['song_title'],
+                'artist_name': raw_seed.get('artist_name', None),
+                'weight': float(weight),
+            })
+        
+        if not any(seed['weight'] > 0 for seed in seeds):
+            return jsonify({"error": "At least one seed needs a positive weight"}), 400
+        
+        result = get_playlist_recommendations(seeds, top_n, **filters, **blend)
+        
+        if "error" in result:
+            status = 500 if result["error"] == "Data not loaded" else 404
+            return jsonify(result), status
+        
+        return json_response(result)
     
     except Exception as e:
         print(f"Exception: {str(e)}")
@@ -264,59 +1202,150 @@ def get_song_recommendations():
 
 @app.route('/api/search', methods=['GET'])
 def search_songs():
-    """Search songs by title or artist"""
+    """Search songs by title or artist, ranked by relevance and paginated"""
     query = request.args.get('q', '').lower()
     
-    if not query:
+    if not query.strip():
         return jsonify({"error": "Search query is required"}), 400
     
-    if data is None:
+    try:
+        limit = int(request.args.get('limit', SEARCH_DEFAULT_LIMIT))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"error": "limit and offset must be integers"}), 400
+    
+    if limit < 1 or offset < 0:
+        return jsonify({"error": "limit must be positive and offset non-negative"}), 400
+    limit = min(limit, SEARCH_MAX_LIMIT)
+    
+    current = model
+    if current is None:
         return jsonify({"error": "Data not loaded"}), 500
     
-    # Search in track names and artist names
-    matching_songs = data[
-        (data['track_name'].str.lower().str.contains(query)) |
-        (data['artist_name'].str.lower().str.contains(query))
-    ]
+    # Search in track names and artist names via the trigram index
+    total, rows = current.search_index.search(query, limit, offset)
     
-    results = matching_songs.loc[:, ['track_name', 'artist_name', 'genre', 'year', 'language', 'mood']].to_dict('records')
-    return jsonify({"results": results})
+    results = current.songs.encoded_rows(rows, SONG_FIELDS)
+    return json_response({
+        "results": results,
+        "total": total,
+        "limit": limit,
+        "offset": offset
+    })
+
+@app.route('/api/suggest', methods=['GET'])
+def suggest_songs():
+    """Typeahead completions for track and artist names"""
+    prefix = request.args.get('prefix', '')
+    
+    try:
+        limit = int(request.args.get('limit', SUGGEST_DEFAULT_LIMIT))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    if limit < 1:
+        return jsonify({"error": "limit must be positive"}), 400
+    
+    current = model
+    if current is None:
+        return jsonify({"error": "Data not loaded"}), 500
+    
+    suggestions = [{"text": text, "type": kind} for text, kind in current.suggest_index.suggest(prefix, limit)]
+    return jsonify({"prefix": prefix, "suggestions": suggestions})
+
+def facet_response(name, build):
+    """Pre-serialized facet response for the current snapshot, with an ETag so
+    browsers and caches can revalidate with If-None-Match and get a 304"""
+    current = model
+    if current is None:
+        return jsonify({"error": "Data not loaded"}), 500
+    
+    body, etag = current.static_response(name, lambda: build(current))
+    response = app.response_class(body, mimetype=app.json.mimetype)
+    response.set_etag(etag)
+    # Cacheable, but revalidated on every use since a reload can change it
+    response.headers['Cache-Control'] = 'public, no-cache'
+    return response.make_conditional(request)
 
 @app.route('/api/genres', methods=['GET'])
 def get_genres():
     """Get all available genres"""
-    if data is None:
-        return jsonify({"error": "Data not loaded"}), 500
-    
-    genres = data['genre'].unique().tolist()
-    return jsonify({"genres": genres})
+    return facet_response('genres', lambda current: {"genres": current.facets['genre'].labels.tolist()})
 
 @app.route('/api/artists', methods=['GET'])
 def get_artists():
     """Get all available artists"""
-    if data is None:
-        return jsonify({"error": "Data not loaded"}), 500
-    
-    artists = data['artist_name'].unique().tolist()
-    return jsonify({"artists": artists})
+    return facet_response('artists', lambda current: {"artists": current.facets['artist_name'].labels.tolist()})
 
 @app.route('/api/languages', methods=['GET'])
 def get_languages():
     """Get all available languages"""
-    if data is None:
-        return jsonify({"error": "Data not loaded"}), 500
-    
-    languages = data['language'].unique().tolist()
-    return jsonify({"languages": languages})
+    return facet_response('languages', lambda current: {"languages": current.facets['language'].labels.tolist()})
 
 @app.route('/api/moods', methods=['GET'])
 def get_moods():
     """Get all available moods"""
-    if data is None:
-        return jsonify({"error": "Data not loaded"}), 500
+    return facet_response('moods', lambda current: {"moods": current.facets['mood'].labels.tolist()})
+
+@app.route('/api/facets', methods=['GET'])
+def get_facets():
+    """Every genre, language, mood and artist with song counts, in one response.
+    cross=1 adds the counts of genre, language and mood within each other."""
+    if request.args.get('cross', '0') not in ('0', ''):
+        return facet_response('facets_cross', lambda current: facet_catalog(current.facets, FACET_COLUMNS))
+    return facet_response('facets', lambda current: facet_catalog(current.facets))
+
+def check_admin_token():
+    """Error response unless the request carries the configured admin token, else None"""
+    if not ADMIN_TOKEN:
+        return jsonify({"error": "Admin endpoints are disabled; set ADMIN_TOKEN to enable them"}), 403
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return jsonify({"error": "Invalid admin token"}), 401
+    return None
+
+@app.route('/api/admin/reload', methods=['GET', 'POST'])
+def reload_catalog():
+    """Start a background reload of the catalog (POST) or report reload status (GET)"""
+    denied = check_admin_token()
+    if denied is not None:
+        return denied
     
-    moods = data['mood'].unique().tolist()
-    return jsonify({"moods": moods})
+    if request.method == 'GET':
+        return jsonify(reloader.status())
+    
+    started = reloader.trigger()
+    if request.args.get('wait', '').lower() in ('1', 'true'):
+        reloader.wait()
+        return jsonify({"started": started, **reloader.status()})
+    return jsonify({"started": started, **reloader.status()}), 202
+
+@app.route('/api/admin/ingest', methods=['POST'])
+def ingest_catalog():
+    """Append new songs to the catalog without refitting the model"""
+    denied = check_admin_token()
+    if denied is not None:
+        return denied
+    
+    try:
+        request_data = request.get_json()
+        records = request_data.get('songs', [])
+        
+        if not isinstance(records, list) or not records:
+            return jsonify({"error": "songs must be a non-empty list"}), 400
+        if len(records) > INGEST_MAX_SONGS:
+            return jsonify({"error": f"At most {INGEST_MAX_SONGS} songs per request"}), 400
+        for record in records:
+            if not isinstance(record, dict) or not str(record.get('track_name') or '').strip() \
+                    or not str(record.get('artist_name') or '').strip():
+                return jsonify({"error": "Every song needs a track_name and an artist_name"}), 400
+        
+        result = ingest_songs(records)
+        if "error" in result:
+            return jsonify(result), 500
+        return jsonify(result)
+        
+    except Exception as e:
+        print(f"Exception: {str(e)}")
+        return jsonify({"error": str(e)}), 500
 
 if __name__ == '__main__':
     print("Loading music data...")
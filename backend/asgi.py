@@ -0,0 +1,225 @@
+import asyncio
+import io
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app as flask_app
+
+# ASGI entry point serving the Flask routes from an asyncio event loop:
+#
+#   gunicorn -k uvicorn_worker.UvicornWorker asgi:application
+#
+# Connections, slow clients and the streaming of large responses are handled
+# on the event loop; only the route handlers (lookups, NumPy/SciPy scoring,
+# JSON encoding) run on a bounded thread pool. Threads share the loaded model,
+# and the heavy numeric work releases the GIL.
+
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', min(32, (os.cpu_count() or 1) + 4)))
+# Requests whose identical concurrent copies share one computation
+COALESCED_PATHS = {'/api/recommendations', '/api/recommendations/batch', '/api/recommendations/playlist'}
+# Request headers the app's response can depend on (body parsing, CORS, auth,
+# content negotiation); coalesced requests must agree on all of them
+COALESCING_HEADERS = {b'content-type', b'content-encoding', b'accept', b'accept-encoding', b'accept-language',
+                      b'authorization', b'cookie', b'origin', b'x-admin-token'}
+
+
+class WSGIResponse:
+    """Status, headers and body chunks produced by a WSGI call"""
+
+    def __init__(self):
+        self.status = None
+        self.headers = []
+        self.written = []  # chunks passed to write() instead of returned
+
+    def start_response(self, status, headers, exc_info=None):
+        self.status = int(status.split(' ', 1)[0])
+        self.headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        return self.written.append
+
+
+class FlaskASGI:
+    """Adapts a WSGI app to ASGI, running it on a bounded thread pool.
+
+    Concurrent POSTs to COALESCED_PATHS with the same query string, the same
+    COALESCING_HEADERS and the same JSON body (key order aside) share one
+    call of the app: the first runs it and the rest wait for its response."""
+
+    def __init__(self, wsgi_app, threads=ASGI_THREADS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi-worker')
+        self.in_flight = {}  # coalescing key -> asyncio.Future of (status, headers, body)
+        self.coalesced = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                print(f"Shutting down; {self.coalesced} requests shared another's computation")
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        body = await read_body(receive)
+        key = coalescing_key(scope, body)
+        if key is None:
+            await self.stream(scope, body, send)
+            return
+
+        status, headers, content = await self.coalesce(key, scope, body)
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': content})
+
+    async def coalesce(self, key, scope, body):
+        """(status, headers, body) of a coalescable request: the response of an
+        identical request in flight, or of running the app for this one"""
+        future = self.in_flight.get(key)
+        while future is not None:
+            try:
+                response = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # This request was cancelled, not the one computing it
+                # The computing request was cancelled; the first waiter to get
+                # here computes the response again and the others wait for it
+                future = self.in_flight.get(key)
+                continue
+            self.coalesced += 1
+            return response
+
+        future = self.in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            response = await self.run(self.call, scope, body)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark retrieved; waiting copies re-raise it
+            raise
+        else:
+            future.set_result(response)
+        finally:
+            del self.in_flight[key]
+        return response
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def call(self, scope, body):
+        """Run the app to completion: (status, headers, body bytes)"""
+        response = WSGIResponse()
+        chunks = self.wsgi_app(wsgi_environ(scope, body), response.start_response)
+        try:
+            content = b''.join(response.written) + b''.join(chunks)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+        return response.status, response.headers, content
+
+    async def stream(self, scope, body, send):
+        """Run the app and send its body as it is produced, one chunk per
+        thread-pool hop, so a streamed song list never holds a thread while
+        waiting on a slow client"""
+        response = WSGIResponse()
+
+        def start():
+            chunks = self.wsgi_app(wsgi_environ(scope, body), response.start_response)
+            return chunks, iter(chunks)
+
+        chunks, iterator = await self.run(start)
+        try:
+            started = False
+            while True:
+                chunk = await self.run(next, iterator, None)
+                if not started:
+                    # Headers go out once the first chunk exists, since start_response may be called late
+                    await send({'type': 'http.response.start', 'status': response.status,
+                                'headers': response.headers})
+                    started = True
+                    pending = b''.join(response.written)
+                    if pending:
+                        await send({'type': 'http.response.body', 'body': pending, 'more_body': True})
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(chunks, 'close'):
+                await self.run(chunks.close)
+
+
+async def read_body(receive):
+    body = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+    return b''.join(body)
+
+
+def coalescing_key(scope, body):
+    """Key identifying a coalescable request, or None if it must run on its own"""
+    if scope['method'] != 'POST' or scope['path'] not in COALESCED_PATHS:
+        return None
+    try:
+        canonical = json.dumps(json.loads(body), sort_keys=True, separators=(',', ':')).encode()
+    except ValueError:
+        canonical = body
+    headers = tuple(sorted((name.lower(), value) for name, value in scope.get('headers', [])
+                           if name.lower() in COALESCING_HEADERS))
+    return scope['path'], scope.get('query_string', b''), headers, canonical
+
+
+def wsgi_environ(scope, body):
+    """PEP 3333 environ for an ASGI HTTP scope"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': str(client[0]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+            continue
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+application = FlaskASGI(flask_app)
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+
+# Numeric audio and lyric-topic columns of the tcc_ceds_music dataset; whichever
+# of them a catalog has are used
+AUDIO_FEATURE_COLUMNS = [
+    'danceability', 'loudness', 'acousticness', 'instrumentalness', 'valence', 'energy',
+    'dating', 'violence', 'world/life', 'night/time', 'shake the audience', 'family/gospel',
+    'romantic', 'communication', 'obscene', 'music', 'movement/places', 'light/visual perceptions',
+    'family/spiritual', 'like/girls', 'sadness', 'feelings', 'len', 'age',
+]
+
+
+class FeatureMatrix:
+    """Songs' numeric features, standardized and held as a contiguous float32 matrix.
+
+    Each column is centered on its mean and scaled by its standard deviation
+    (missing values become the mean), and each row is then scaled to unit
+    length. A song's feature similarity to the whole catalog is therefore the
+    cosine of their standardized profiles: one matrix-vector product."""
+
+    def __init__(self, columns, vectors, mean, scale):
+        self.columns = list(columns)
+        self.vectors = vectors  # float32 (songs x features), unit rows
+        self.mean = mean  # float64 per column
+        self.scale = scale  # float64 per column; 1 where a column is constant
+
+    @classmethod
+    def build(cls, frame):
+        """Matrix over the AUDIO_FEATURE_COLUMNS frame has, or None if it has none"""
+        columns = [column for column in AUDIO_FEATURE_COLUMNS if column in frame.columns]
+        if not columns:
+            return None
+        values = frame[columns].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+        mean = np.nan_to_num(np.nanmean(values, axis=0)) if len(values) else np.zeros(len(columns))
+        scale = np.nan_to_num(np.nanstd(values, axis=0)) if len(values) else np.ones(len(columns))
+        scale[scale == 0] = 1
+        features = cls(columns, None, mean, scale)
+        features.vectors = features.standardize(values)
+        return features
+
+    def standardize(self, values):
+        """Unit-length float32 rows for raw feature values (songs x columns)"""
+        values = (np.asarray(values, dtype=np.float64) - self.mean) / self.scale
+        values = np.nan_to_num(values)
+        norms = np.linalg.norm(values, axis=1, keepdims=True)
+        return np.ascontiguousarray(values / np.where(norms > 0, norms, 1), dtype=np.float32)
+
+    def profile(self, rows, weights=None):
+        """Unit query vector: the (weighted) mean profile of catalog rows"""
+        rows = np.asarray(rows, dtype=np.intp)
+        weights = np.ones(len(rows)) if weights is None else np.asarray(weights, dtype=np.float64)
+        return unit(weights @ self.vectors[rows])
+
+    def target(self, values):
+        """Unit query vector for target raw values, e.g. {'valence': 0.9, 'energy': 0.8};
+        columns not given are taken to be at their mean"""
+        unknown = [column for column in values if column not in self.columns]
+        if unknown:
+            raise ValueError(f"Unknown audio features: {', '.join(unknown)}")
+        standardized = np.zeros(len(self.columns))
+        for column, value in values.items():
+            i = self.columns.index(column)
+            standardized[i] = (float(value) - self.mean[i]) / self.scale[i]
+        return unit(standardized)
+
+    def append(self, frame):
+        """New matrix with rows for frame's songs, standardized with the existing
+        mean and scale so earlier rows stay comparable"""
+        values = frame.reindex(columns=self.columns).apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+        return FeatureMatrix(self.columns, np.concatenate([self.vectors, self.standardize(values)]),
+                             self.mean, self.scale)
+
+    def arrays(self):
+        return {'columns': np.array(self.columns, dtype=str), 'vectors': self.vectors,
+                'mean': self.mean, 'scale': self.scale}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['columns'].tolist(), arrays['vectors'], arrays['mean'], arrays['scale'])
+
+
+def unit(vector):
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm > 0 else vector).astype(np.float32)
+
+
+def blend_scores(text_scores, features, query, weight):
+    """(1 - weight) * text similarity + weight * feature similarity, for every
+    song. The weight is folded into the query, so the feature side costs a
+    single matrix-vector product over the float32 feature matrix."""
+    scores = features.vectors.dot(query * np.float32(weight)).astype(np.float64)
+    scores += (1 - weight) * text_scores
+    return scores
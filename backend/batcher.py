@@ -0,0 +1,122 @@
+import threading
+import time
+
+from scoring import score_row, score_rows
+
+
+class PendingQuery:
+    __slots__ = ('matrix', 'matrix_t', 'row', 'enqueued_at', 'ready', 'done', 'scores', 'error')
+
+    def __init__(self, matrix, matrix_t, row):
+        self.matrix = matrix
+        self.matrix_t = matrix_t
+        self.row = row
+        self.enqueued_at = time.monotonic()
+        self.ready = threading.Event()  # set when scored, or when this query's thread is to collect the next batch
+        self.done = False
+        self.scores = None
+        self.error = None
+
+
+class MicroBatcher:
+    """Scores single-row queries from concurrent threads together.
+
+    The thread of the oldest pending query collects a batch: it waits up to
+    window seconds from that query's arrival, or until max_size queries are
+    pending, then scores them all with one matrix product (score_rows()) and
+    hands every waiting thread its row of the result. Queries left over for
+    the next batch pass the collecting on to the oldest of them, so other
+    threads only ever wait on their own query."""
+
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max(1, max_size)
+        self._cond = threading.Condition()
+        self._pending = []
+        self._collecting = False  # a thread owns the pending queries; False only while none are pending
+        self.batches = 0
+        self.queries = 0
+        self.max_batch_size = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+
+    def score(self, matrix, matrix_t, row):
+        """Cosine similarities of catalog row against every row, like score_row()"""
+        query = PendingQuery(matrix, matrix_t, row)
+        with self._cond:
+            self._pending.append(query)
+            collect = not self._collecting
+            if collect:
+                self._collecting = True
+            elif len(self._pending) >= self.max_size:
+                self._cond.notify()  # the batch is full; wake its collector early
+
+        if not collect:
+            query.ready.wait()
+        if not query.done:
+            # This thread's query is the oldest pending one, so it is in the batch it collects
+            self._run(self._collect())
+
+        if query.error is not None:
+            raise query.error
+        return query.scores
+
+    def _collect(self):
+        """Wait for the oldest pending query's window to close or the batch to fill, then take the batch"""
+        with self._cond:
+            deadline = self._pending[0].enqueued_at + self.window
+            while len(self._pending) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending[:self.max_size]
+            del self._pending[:self.max_size]
+            if self._pending:
+                self._pending[0].ready.set()
+            else:
+                self._collecting = False
+
+            delays = [time.monotonic() - query.enqueued_at for query in batch]
+            self.batches += 1
+            self.queries += len(batch)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+            self.total_delay += sum(delays)
+            self.max_delay = max(self.max_delay, max(delays))
+        return batch
+
+    def _run(self, batch):
+        # Queries made against different snapshots (a reload landed mid-batch) are scored separately
+        groups = {}
+        for query in batch:
+            groups.setdefault(id(query.matrix), []).append(query)
+        try:
+            for queries in groups.values():
+                try:
+                    scores = score_rows(queries[0].matrix, queries[0].matrix_t, [query.row for query in queries])
+                except Exception:
+                    # Score one by one so a failing query does not fail the others
+                    for query in queries:
+                        try:
+                            query.scores = score_row(query.matrix, query.matrix_t, query.row)
+                        except Exception as e:
+                            query.error = e
+                else:
+                    for query, row_scores in zip(queries, scores):
+                        query.scores = row_scores
+        finally:
+            for query in batch:
+                query.done = True
+                query.ready.set()
+
+    def stats(self):
+        return {
+            "window_ms": self.window * 1000,
+            "max_size": self.max_size,
+            "batches": self.batches,
+            "queries": self.queries,
+            "mean_batch_size": round(self.queries / self.batches, 2) if self.batches else None,
+            "max_batch_size": self.max_batch_size,
+            "mean_queue_delay_ms": round(self.total_delay / self.queries * 1000, 3) if self.queries else None,
+            "max_queue_delay_ms": round(self.max_delay * 1000, 3),
+        }
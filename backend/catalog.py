@@ -0,0 +1,156 @@
+import argparse
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # Only needed for Parquet and Feather catalogs
+    pyarrow = None
+
+# Low-cardinality text columns stored as categoricals (dictionary-encoded) in columnar catalogs
+CATEGORICAL_COLUMNS = ['genre', 'language', 'mood']
+FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.feather': 'feather', '.arrow': 'feather'}
+
+
+def catalog_format(path):
+    """'csv', 'parquet' or 'feather', from the file extension"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError(f"Unsupported catalog format '{extension}' (use one of {', '.join(FORMATS)})")
+    fmt = FORMATS[extension]
+    if fmt != 'csv' and pyarrow is None:
+        raise ImportError(f"Reading {fmt} catalogs requires pyarrow (pip install pyarrow)")
+    return fmt
+
+
+def text_values(series):
+    """Column as strings with '' where missing; also works for categorical columns"""
+    return series.astype(object).fillna('').astype(str)
+
+
+class Catalog:
+    """Column-level access to the catalog file.
+
+    Parquet and Feather files are read one projection at a time, so each
+    build step loads only the columns it uses. A CSV cannot be read by
+    column, so it is parsed once on first use and the parsed frame is kept
+    until the Catalog is dropped."""
+
+    def __init__(self, path):
+        self.path = path
+        self.format = catalog_format(path)
+        self._frame = None  # Parsed CSV
+
+    @property
+    def columns(self):
+        """Column names, read from the header or schema only"""
+        if self.format == 'csv':
+            return list(pd.read_csv(self.path, nrows=0).columns)
+        if self.format == 'parquet':
+            return pyarrow.parquet.read_schema(self.path).names
+        with pyarrow.memory_map(self.path) as source:
+            return pyarrow.ipc.open_file(source).schema.names
+
+    def read(self, columns=None):
+        """DataFrame with the requested columns (all when None), in file order.
+        Requested columns the file does not have are left out."""
+        if columns is not None:
+            available = self.columns
+            columns = [column for column in available if column in columns]
+
+        if self.format == 'csv':
+            if self._frame is None:
+                self._frame = pd.read_csv(self.path)
+            frame = self._frame if columns is None else self._frame[columns]
+            return frame.copy()
+        if self.format == 'parquet':
+            return pd.read_parquet(self.path, columns=columns)
+        return pd.read_feather(self.path, columns=columns)
+
+    def iter_chunks(self, chunk_rows, columns=None):
+        """DataFrames of at most chunk_rows rows each, in file order, holding
+        the requested columns (all when None) that the file has. Only one
+        chunk is materialized at a time."""
+        if columns is not None:
+            available = self.columns
+            columns = [column for column in available if column in columns]
+
+        if self.format == 'csv':
+            with pd.read_csv(self.path, usecols=columns, chunksize=chunk_rows) as reader:
+                yield from reader
+        elif self.format == 'parquet':
+            for batch in pyarrow.parquet.ParquetFile(self.path).iter_batches(batch_size=chunk_rows, columns=columns):
+                yield batch.to_pandas()
+        else:
+            # Record batches of a memory-mapped Feather file are zero-copy views of the mapping
+            with pyarrow.memory_map(self.path) as source:
+                table = pyarrow.ipc.open_file(source).read_all()
+                if columns is not None:
+                    table = table.select(columns)
+                for batch in table.to_batches(max_chunksize=chunk_rows):
+                    yield batch.to_pandas()
+
+    def append(self, frame):
+        """Append rows to the file, in its own column order"""
+        frame = frame.reindex(columns=self.columns)
+        if self.format == 'csv':
+            needs_newline = False
+            if os.path.getsize(self.path) > 0:
+                with open(self.path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    needs_newline = f.read(1) != b'\n'
+            with open(self.path, 'a', newline='') as f:
+                if needs_newline:
+                    f.write('\n')
+                frame.to_csv(f, header=False, index=False)
+        else:
+            # Columnar files cannot be appended to in place; rewrite them
+            existing = self.read()
+            for column in existing.columns:
+                if isinstance(existing[column].dtype, pd.CategoricalDtype):
+                    existing[column] = existing[column].astype(object)
+            write_catalog(pd.concat([existing, frame], ignore_index=True), self.path)
+        self._frame = None
+
+
+def encode_columns(frame, categorical=CATEGORICAL_COLUMNS):
+    """Copy of frame with the given text columns as categoricals"""
+    frame = frame.copy()
+    for column in categorical:
+        if column in frame.columns:
+            frame[column] = frame[column].astype('category')
+    return frame
+
+
+def write_catalog(frame, path, categorical=CATEGORICAL_COLUMNS):
+    """Write a catalog in the format given by the path's extension.
+    The file is written next to its destination and renamed into place."""
+    fmt = catalog_format(path)
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    if fmt == 'csv':
+        frame.to_csv(tmp_path, index=False)
+    elif fmt == 'parquet':
+        encode_columns(frame, categorical).to_parquet(tmp_path, index=False)
+    else:
+        encode_columns(frame, categorical).reset_index(drop=True).to_feather(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the music catalog between CSV, Parquet and Feather")
+    parser.add_argument('source', help="catalog to read, e.g. music_data.csv")
+    parser.add_argument('destination', help="file to write, e.g. music_data.parquet")
+    parser.add_argument('--categorical', nargs='*', default=CATEGORICAL_COLUMNS,
+                        help="text columns to dictionary-encode")
+    args = parser.parse_args()
+
+    frame = Catalog(args.source).read()
+    write_catalog(frame, args.destination, args.categorical)
+    size = os.path.getsize(args.destination)
+    print(f"Wrote {len(frame)} songs to {args.destination} ({size / 1e6:.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import numpy as np
+from sklearn.decomposition import TruncatedSVD
+from sklearn.preprocessing import normalize
+
+DEFAULT_DIMS = 64
+
+
+def embedding_dims(shape, dims):
+    """Dimensions actually fitted for a matrix of this shape"""
+    return max(1, min(dims, shape[1] - 1, shape[0] - 1))
+
+
+def blockwise_components(matrix, dims, block_rows, seed=0, n_iter=7, oversample=10):
+    """Top right singular vectors (dims x vocabulary, float32) of a sparse
+    matrix read block_rows rows at a time, e.g. one memory-mapped from disk.
+
+    Randomized subspace iteration on matrix.T @ matrix: every iteration is
+    one pass over the rows, and only a dense vocabulary x (dims + oversample)
+    basis is held, never anything with a row per song. The components are
+    then the top eigenvectors of the Gram matrix within that basis."""
+    n_rows, n_terms = matrix.shape
+    width = min(dims + oversample, n_terms)
+
+    def blocks():
+        for start in range(0, n_rows, block_rows):
+            yield matrix[start:start + block_rows]
+
+    basis = np.random.default_rng(seed).standard_normal((n_terms, width))
+    for _ in range(n_iter):
+        product = np.zeros_like(basis)
+        for rows in blocks():
+            product += rows.T @ (rows @ basis)
+        basis = np.linalg.qr(product)[0]
+
+    gram = np.zeros((width, width))
+    for rows in blocks():
+        projected = rows @ basis
+        gram += projected.T @ projected
+    values, vectors = np.linalg.eigh(gram)
+    top = np.argsort(values)[::-1][:dims]
+    return np.ascontiguousarray((basis @ vectors[:, top]).T, dtype=np.float32)
+
+
+class Embedding:
+    """Dense float32 song vectors from a truncated SVD (LSA) of the TF-IDF rows.
+
+    Vectors are L2-normalized and stored row-major and contiguous, so one
+    song's similarities to the catalog are a single matrix-vector product
+    whose cost depends only on the number of dimensions, not the vocabulary.
+    The SVD components are kept to project songs added later."""
+
+    def __init__(self, vectors, components):
+        self.vectors = vectors  # float32 (songs x dims), unit rows
+        self.components = components  # float32 (dims x vocabulary)
+
+    @classmethod
+    def fit(cls, matrix, dims=DEFAULT_DIMS, seed=0):
+        dims = embedding_dims(matrix.shape, dims)
+        print(f"Fitting {dims}-dimensional SVD embedding...")
+        svd = TruncatedSVD(n_components=dims, algorithm='randomized', random_state=seed)
+        svd.fit(matrix)
+        embedding = cls(None, np.ascontiguousarray(svd.components_, dtype=np.float32))
+        embedding.vectors = embedding.project(matrix)
+        return embedding
+
+    @property
+    def dims(self):
+        return self.components.shape[0]
+
+    def project(self, rows):
+        """Unit-length embedding vectors for sparse TF-IDF rows"""
+        vectors = np.asarray(rows @ self.components.T, dtype=np.float32)
+        return np.ascontiguousarray(normalize(vectors, norm='l2', copy=False))
+
+    def append(self, rows):
+        """New embedding with vectors for sparse TF-IDF rows added at the end"""
+        return Embedding(np.concatenate([self.vectors, self.project(rows)]), self.components)
+
+    def arrays(self):
+        return {'vectors': self.vectors, 'components': self.components}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['vectors'], arrays['components'])
@@ -0,0 +1,143 @@
+import numpy as np
+import pandas as pd
+
+from catalog import text_values
+
+FACET_COLUMNS = ['mood', 'language', 'genre']
+
+
+def normalize_value(value):
+    """Key used for case-insensitive facet matching"""
+    return str(value).strip().lower()
+
+
+class Facet:
+    """One categorical column: a code per row plus the distinct values.
+
+    Values are listed in order of first appearance; code -1 marks rows
+    with no value. Everything is a plain array, so it can be memory-mapped."""
+
+    def __init__(self, codes, keys, labels):
+        self.codes = codes  # int32 per row
+        self.keys = keys  # normalized values (str array)
+        self.labels = labels  # values as first written in the catalog (str array)
+
+    @classmethod
+    def build(cls, series):
+        raw = text_values(series).str.strip()
+        codes, keys = pd.factorize(raw.str.lower())
+        codes = codes.astype(np.int32)
+        # First original spelling of each normalized value
+        first_rows = np.unique(codes, return_index=True)[1]
+        labels = raw.to_numpy()[first_rows]
+
+        empty = np.flatnonzero(keys == '')
+        if len(empty):
+            # Rows without a value get -1 and the empty key is dropped
+            codes[codes == empty[0]] = -1
+            codes[codes > empty[0]] -= 1
+            keep = np.arange(len(keys)) != empty[0]
+            keys, labels = keys[keep], labels[keep]
+
+        return cls(codes, np.array(keys, dtype=str), np.array(labels, dtype=str))
+
+    def mask(self, value):
+        """Boolean row mask for one value (all False if the value is unknown)"""
+        code = np.flatnonzero(self.keys == normalize_value(value))
+        if len(code) == 0:
+            return np.zeros(len(self.codes), dtype=bool)
+        return self.codes == code[0]
+
+    def append(self, series):
+        """New facet with more rows; values not seen before get the next codes"""
+        raw = text_values(series).str.strip()
+        keys = self.keys.tolist()
+        labels = self.labels.tolist()
+        positions = {key: code for code, key in enumerate(keys)}
+        codes = np.full(len(raw), -1, dtype=np.int32)
+        for i, (label, key) in enumerate(zip(raw, raw.str.lower())):
+            if not key:
+                continue
+            code = positions.get(key)
+            if code is None:
+                code = positions[key] = len(keys)
+                keys.append(key)
+                labels.append(label)
+            codes[i] = code
+        return Facet(np.concatenate([self.codes, codes]), np.array(keys, dtype=str), np.array(labels, dtype=str))
+
+    def arrays(self):
+        return {'codes': self.codes, 'keys': self.keys, 'labels': self.labels}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['codes'], arrays['keys'], arrays['labels'])
+
+
+def build_facets(data, columns=FACET_COLUMNS):
+    """Facet per column, keyed by column name"""
+    return {column: Facet.build(data[column]) for column in columns}
+
+
+def value_counts(facet):
+    """Number of rows with each value, in the order of facet.labels"""
+    return np.bincount(facet.codes[facet.codes >= 0], minlength=len(facet.keys))
+
+
+def cross_counts(facet, by):
+    """{value of by: {value of facet: rows}} over rows that have both, e.g.
+    genres within each language. Pairs that never occur are left out."""
+    both = (facet.codes >= 0) & (by.codes >= 0)
+    pairs = by.codes[both].astype(np.int64) * len(facet.keys) + facet.codes[both]
+    counts = np.bincount(pairs, minlength=len(by.keys) * len(facet.keys)).reshape(len(by.keys), len(facet.keys))
+    labels = facet.labels.tolist()
+    return {
+        by_label: {labels[code]: int(counts[row, code]) for code in np.flatnonzero(counts[row])}
+        for row, by_label in enumerate(by.labels.tolist())
+    }
+
+
+def facet_catalog(facets, cross_columns=None):
+    """Every value of every facet with its row count. With cross_columns, also
+    the counts of each of those facets within each value of the others."""
+    catalog = {
+        column: [{"value": label, "count": int(count)} for label, count in zip(facet.labels.tolist(), value_counts(facet))]
+        for column, facet in facets.items()
+    }
+    if not cross_columns:
+        return {"facets": catalog}
+
+    cross = {}
+    for column in cross_columns:
+        for by in cross_columns:
+            if column != by:
+                cross[f"{column}_by_{by}"] = cross_counts(facets[column], facets[by])
+    return {"facets": catalog, "cross": cross}
+
+
+def build_year_array(data):
+    """Release years as floats, NaN where unknown, for range filtering"""
+    if 'year' not in data.columns:
+        return np.full(len(data), np.nan)
+    return pd.to_numeric(data['year'], errors='coerce').to_numpy(dtype=np.float64)
+
+
+def filter_mask(facets, years, mood=None, language=None, genre=None, year_min=None, year_max=None):
+    """Boolean row mask for the requested filters, or None when nothing is filtered"""
+    mask = None
+
+    for column, value in (('mood', mood), ('language', language), ('genre', genre)):
+        if not value:
+            continue
+        column_mask = facets[column].mask(value)
+        mask = column_mask if mask is None else mask & column_mask
+
+    if year_min is not None or year_max is not None:
+        year_mask = np.ones(len(years), dtype=bool) if mask is None else mask
+        if year_min is not None:
+            year_mask &= years >= year_min
+        if year_max is not None:
+            year_mask &= years <= year_max
+        mask = year_mask
+
+    return mask
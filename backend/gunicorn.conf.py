@@ -0,0 +1,21 @@
+import gc
+import os
+
+# gunicorn reads this file automatically when started from the backend directory.
+
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+# Import the app (and load the model) once in the master before forking, so
+# every worker shares the same memory-mapped model pages instead of loading
+# its own copy.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+
+def when_ready(server):
+    """Move everything loaded so far out of the garbage collector's reach.
+
+    Without this the first collection in each worker touches the header of
+    every preloaded object and turns the shared pages into private copies."""
+    gc.collect()
+    gc.freeze()
+    server.log.info("Froze %d preloaded objects", gc.get_freeze_count())
@@ -0,0 +1,454 @@
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+from strings import StringColumn, SortedView, nested_arrays, child_arrays
+
+PREFIX_SENTINEL = chr(0x10FFFF)  # Sorts after any character a name can contain
+KIND_NAMES = ('track', 'artist')
+
+
+def normalize_text(text):
+    """Lower-case and collapse whitespace so lookups ignore case and spacing"""
+    return ' '.join(str(text).lower().split())
+
+
+def trigrams(text):
+    """Distinct character trigrams of an already-normalized string"""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def trigram_code(gram):
+    """Pack a trigram into one int64 (21 bits per code point)"""
+    return (ord(gram[0]) << 42) | (ord(gram[1]) << 21) | ord(gram[2])
+
+
+class TrigramIndex:
+    """Character-trigram posting lists answering substring queries without a full scan.
+
+    Postings are stored CSR-style: sorted trigram codes, offsets into one
+    array of row ids, and the normalized texts as a StringColumn."""
+
+    def __init__(self, texts, keys, offsets, rows):
+        self.texts = texts  # StringColumn of normalized texts
+        self.keys = keys  # int64 trigram codes, sorted
+        self.offsets = offsets  # int64, len(keys) + 1
+        self.rows = rows  # int32 row ids, ascending within each trigram
+
+    @classmethod
+    def build(cls, texts):
+        """Index an iterable of raw strings"""
+        normalized = [normalize_text(text) for text in texts]
+        codes = []
+        rows = []
+        for row, text in enumerate(normalized):
+            grams = trigrams(text)
+            codes.extend(trigram_code(gram) for gram in grams)
+            rows.extend([row] * len(grams))
+
+        codes = np.array(codes, dtype=np.int64)
+        rows = np.array(rows, dtype=np.int32)
+        order = np.lexsort((rows, codes))
+        codes = codes[order]
+        keys, starts = np.unique(codes, return_index=True)
+        offsets = np.append(starts, len(codes)).astype(np.int64)
+        return cls(StringColumn.from_strings(normalized), keys, offsets, rows[order])
+
+    def postings(self, gram):
+        """Rows containing a trigram, or None if no text does"""
+        code = trigram_code(gram)
+        i = int(np.searchsorted(self.keys, code))
+        if i == len(self.keys) or self.keys[i] != code:
+            return None
+        return self.rows[self.offsets[i]:self.offsets[i + 1]]
+
+    def candidates(self, query):
+        """Rows containing every trigram of the query (a superset of the substring matches)"""
+        grams = trigrams(query)
+        if not grams:
+            return None
+
+        lists = [self.postings(gram) for gram in grams]
+        if any(rows is None for rows in lists):
+            return np.empty(0, dtype=np.int32)
+
+        # Intersect shortest lists first so the candidate set shrinks fastest
+        lists.sort(key=len)
+        rows = lists[0]
+        for other in lists[1:]:
+            rows = np.intersect1d(rows, other, assume_unique=True)
+            if len(rows) == 0:
+                break
+        return rows
+
+    def find(self, query):
+        """Rows whose text contains the normalized query, in ascending row order"""
+        return self.matches(query)[0]
+
+    def matches(self, query):
+        """Rows whose text contains the normalized query, in ascending row order,
+        and the relevance tier of each (int8, lower is better): 0 for an exact
+        match, 1 for a prefix, 2 for a word prefix and 3 for any other substring.
+
+        The query's trigrams narrow the texts to verify; queries shorter than
+        a trigram are matched against the whole buffer. Either way the
+        matching and the tiers are computed vectorized, per byte position."""
+        query = normalize_text(query)
+        candidates = self.candidates(query)
+        texts = self.texts if candidates is None else self.texts.subset(candidates)
+        hit_rows, positions = texts.occurrences(query)
+        if len(hit_rows) == 0:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int8)
+
+        starts = texts.offsets[hit_rows]
+        at_start = positions == starts
+        exact = at_start & (texts.offsets[hit_rows + 1] - starts == len(query.encode('utf-8')))
+        # Texts are normalized, so words are separated by exactly one space
+        at_word = at_start | (texts.buffer[np.maximum(positions - 1, 0)] == ord(' '))
+        tiers = np.select([exact, at_start, at_word], [0, 1, 2], 3).astype(np.int8)
+
+        # Hits come in row order; a row's tier is that of its best hit
+        first = np.flatnonzero(np.r_[True, hit_rows[1:] != hit_rows[:-1]])
+        rows = hit_rows[first]
+        tiers = np.minimum.reduceat(tiers, first)
+        if candidates is not None:
+            rows = candidates[rows]
+        return rows.astype(np.int32), tiers
+
+    def append(self, texts):
+        """New index with texts added as the next rows (this one is left unchanged)"""
+        tail = TrigramIndex.build(texts)
+        tail_codes = np.repeat(tail.keys, np.diff(tail.offsets))
+        tail_rows = tail.rows + len(self.texts)
+
+        # Appended rows have the highest ids, so each posting goes at the end of
+        # its trigram's list; np.insert keeps equal positions in the given order
+        positions = self.offsets[np.searchsorted(self.keys, tail_codes, side='right')]
+        rows = np.insert(self.rows, positions, tail_rows)
+
+        keys = np.union1d(self.keys, tail.keys)
+        counts = np.zeros(len(keys), dtype=np.int64)
+        counts[np.searchsorted(keys, self.keys)] += np.diff(self.offsets)
+        counts[np.searchsorted(keys, tail.keys)] += np.diff(tail.offsets)
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return TrigramIndex(self.texts.concat(tail.texts), keys, offsets, rows)
+
+    def arrays(self):
+        arrays = nested_arrays('texts', self.texts.arrays())
+        arrays.update({'keys': self.keys, 'offsets': self.offsets, 'rows': self.rows})
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        texts = StringColumn.from_arrays(child_arrays('texts', arrays))
+        return cls(texts, arrays['keys'], arrays['offsets'], arrays['rows'])
+
+
+class TitleIndex:
+    """Normalized title -> row ids, with a trigram fallback for partial titles"""
+
+    def __init__(self, titles, artists, order):
+        self.substrings = titles  # TrigramIndex over titles
+        self.artists = artists  # StringColumn of normalized artist names
+        self.order = order  # int32 rows sorted by (normalized title, row)
+        self.sorted_titles = SortedView(titles.texts, order)
+
+    @classmethod
+    def build(cls, titles, artists):
+        """Index a title TrigramIndex and the matching normalized artist column"""
+        texts = titles.texts.to_list()
+        order = np.array(sorted(range(len(texts)), key=lambda row: (texts[row], row)), dtype=np.int32)
+        return cls(titles, artists, order)
+
+    def exact(self, key):
+        """Rows whose normalized title equals key, in catalog order"""
+        start = bisect_left(self.sorted_titles, key)
+        stop = start
+        while stop < len(self.order) and self.sorted_titles[stop] == key:
+            stop += 1
+        return self.order[start:stop]
+
+    def lookup(self, title, artist=None):
+        """Row id of the best match for a title, or None if nothing matches.
+
+        Exact (case-insensitive) matches win over partial ones. When several
+        tracks share the title, the artist (if given) picks between them,
+        otherwise the first track in catalog order is used."""
+        key = normalize_text(title)
+        if not key:
+            return None
+
+        rows = self.exact(key)
+        if len(rows) == 0:
+            rows = self.substrings.find(key)
+        if len(rows) == 0:
+            return None
+
+        return int(self.pick_by_artist(rows, artist))
+
+    def pick_by_artist(self, rows, artist):
+        """Choose among rows with the same title, preferring the requested artist"""
+        artist = normalize_text(artist) if artist else ''
+        if artist and len(rows) > 1:
+            for matches in (lambda name: name == artist, lambda name: artist in name):
+                for row in rows:
+                    if matches(self.artists[row]):
+                        return row
+        return rows[0]
+
+    def append(self, titles, artists):
+        """New index over title and artist columns that extend the indexed ones"""
+        first_row = len(self.order)
+        new_texts = titles.texts.take(range(first_row, len(titles.texts)))
+        new_order = sorted(range(len(new_texts)), key=lambda i: (new_texts[i], i))
+        # An appended title goes after every equal title already indexed (its row id is higher)
+        positions = [bisect_right(self.sorted_titles, new_texts[i]) for i in new_order]
+        rows = np.array(new_order, dtype=np.int32) + first_row
+        return TitleIndex(titles, artists, np.insert(self.order, positions, rows))
+
+    def arrays(self):
+        return {'order': self.order}
+
+    @classmethod
+    def from_arrays(cls, arrays, titles, artists):
+        return cls(titles, artists, arrays['order'])
+
+
+class SearchIndex:
+    """Ranked substring search over track titles and artist names"""
+
+    def __init__(self, titles, artists):
+        self.titles = titles  # TrigramIndex over titles
+        self.artists = artists  # TrigramIndex over artist names
+
+    def search(self, query, limit, offset=0):
+        """Total match count and the row ids of one ranked page of results.
+
+        Exact matches rank above prefix, word-prefix and plain substring
+        matches; at equal tiers title matches come before artist matches,
+        then catalog order."""
+        query = normalize_text(query)
+        if not query:
+            return 0, np.empty(0, dtype=np.int32)
+
+        title_rows, title_tiers = self.titles.matches(query)
+        artist_rows, artist_tiers = self.artists.matches(query)
+        rows = np.concatenate([title_rows, artist_rows])
+        ranks = np.concatenate([2 * title_tiers, 2 * artist_tiers + 1])
+
+        # Keep each row once, with its better rank
+        order = np.lexsort((ranks, rows))
+        rows, ranks = rows[order], ranks[order]
+        keep = np.ones(len(rows), dtype=bool)
+        keep[1:] = rows[1:] != rows[:-1]
+        rows, ranks = rows[keep], ranks[keep]
+
+        order = np.lexsort((rows, ranks))
+        return len(rows), rows[order[offset:offset + limit]]
+
+
+class PrefixIndex:
+    """Typeahead completions over normalized track and artist names.
+
+    Names are kept in one sorted array, so all completions of a prefix form
+    a contiguous range found with two bisections. Each name carries a rank
+    from its prior (how many catalog tracks carry it, then how recent the
+    newest one is). Prefixes whose range is larger than heavy_threshold
+    have their best completions precomputed, so a query never ranks more
+    than heavy_threshold entries."""
+
+    def __init__(self, texts, display, kinds, counts, newest, ranks, heavy_keys, heavy_positions, heavy_threshold):
+        self.texts = texts  # StringColumn of sorted normalized names
+        self.display = display  # StringColumn of the names as shown to users
+        self.kinds = kinds  # int8 index into KIND_NAMES
+        self.counts = counts  # int32 tracks carrying the name
+        self.newest = newest  # int32 newest release year (0 if unknown)
+        self.ranks = ranks  # int32 prior rank, 0 is best
+        self.heavy_keys = heavy_keys  # StringColumn of sorted heavy prefixes
+        self.heavy_positions = heavy_positions  # int32 (len(heavy_keys), max_suggestions), -1 padded
+        self.heavy_threshold = heavy_threshold
+        self.max_suggestions = heavy_positions.shape[1]
+
+    @classmethod
+    def build(cls, titles, artists, years, max_suggestions=10, heavy_threshold=256):
+        entries = cls._aggregate(titles, artists, years)
+        keys = sorted(entries)
+        return cls._assemble(
+            [key for key, kind in keys],
+            [entries[key][0] for key in keys],
+            np.array([kind for key, kind in keys], dtype=np.int8),
+            np.array([entries[key][1] for key in keys], dtype=np.int32),
+            np.array([entries[key][2] for key in keys], dtype=np.int32),
+            max_suggestions,
+            heavy_threshold,
+        )
+
+    def append(self, titles, artists, years):
+        """New index with the names of more tracks merged in"""
+        entries = self._aggregate(titles, artists, years)
+        texts = self.texts.to_list()
+        display = self.display.to_list()
+        counts = np.array(self.counts)
+        newest = np.array(self.newest)
+
+        inserts = []  # (position, key, kind, entry) for names not indexed yet
+        for (key, kind), (name, count, year) in sorted(entries.items()):
+            pos = bisect_left(texts, key)
+            while pos < len(texts) and texts[pos] == key and self.kinds[pos] < kind:
+                pos += 1
+            if pos < len(texts) and texts[pos] == key and self.kinds[pos] == kind:
+                counts[pos] += count
+                newest[pos] = max(newest[pos], year)
+            else:
+                inserts.append((pos, key, kind, name, count, year))
+
+        positions = [pos for pos, *_ in inserts]
+        kinds = np.insert(self.kinds, positions, [kind for _, _, kind, *_ in inserts])
+        counts = np.insert(counts, positions, [count for *_, count, _ in inserts])
+        newest = np.insert(newest, positions, [year for *_, year in inserts])
+        # Insert from the back so earlier positions stay valid
+        for pos, key, kind, name, count, year in reversed(inserts):
+            texts.insert(pos, key)
+            display.insert(pos, name)
+
+        return self._assemble(texts, display, kinds, counts, newest, self.max_suggestions, self.heavy_threshold)
+
+    @staticmethod
+    def _aggregate(titles, artists, years):
+        """(normalized name, kind) -> [display name, track count, newest year]"""
+        entries = {}
+        for kind, names in enumerate((titles, artists)):
+            for name, year in zip(names, years):
+                key = normalize_text(name)
+                if not key:
+                    continue
+                year = 0 if year != year else int(year)  # NaN -> unknown
+                entry = entries.get((key, kind))
+                if entry is None:
+                    entries[(key, kind)] = [str(name).strip(), 1, year]
+                else:
+                    entry[1] += 1
+                    entry[2] = max(entry[2], year)
+        return entries
+
+    @classmethod
+    def _assemble(cls, texts, display, kinds, counts, newest, max_suggestions, heavy_threshold):
+        """Index over entries already sorted by (normalized name, kind)"""
+        # Most tracks first, then newest, then alphabetical (= sorted position)
+        prior_order = np.lexsort((np.arange(len(texts)), -newest.astype(np.int64), -counts.astype(np.int64)))
+        ranks = np.empty(len(texts), dtype=np.int32)
+        ranks[prior_order] = np.arange(len(texts), dtype=np.int32)
+
+        heavy_keys, heavy_positions = cls.heavy_completions(texts, ranks, max_suggestions, heavy_threshold)
+        return cls(
+            StringColumn.from_strings(texts),
+            StringColumn.from_strings(display),
+            kinds,
+            counts,
+            newest,
+            ranks,
+            heavy_keys,
+            heavy_positions,
+            heavy_threshold,
+        )
+
+    @classmethod
+    def heavy_completions(cls, texts, ranks, max_suggestions, heavy_threshold):
+        """(heavy_keys, heavy_positions) for names sorted as the index keeps them
+        (a list or a StringColumn) and their prior ranks"""
+        heavy = cls._heavy_prefixes(texts, ranks, max_suggestions, heavy_threshold)
+        heavy_keys = sorted(heavy)
+        heavy_positions = np.full((len(heavy_keys), max_suggestions), -1, dtype=np.int32)
+        for i, prefix in enumerate(heavy_keys):
+            heavy_positions[i, :len(heavy[prefix])] = heavy[prefix]
+        return StringColumn.from_strings(heavy_keys), heavy_positions
+
+    @staticmethod
+    def _range(texts, prefix, lo=0, hi=None):
+        """[start, stop) of the sorted texts beginning with prefix"""
+        hi = len(texts) if hi is None else hi
+        start = bisect_left(texts, prefix, lo, hi)
+        stop = bisect_left(texts, prefix + PREFIX_SENTINEL, start, hi)
+        return start, stop
+
+    @staticmethod
+    def _best(ranks, start, stop, k, block=1 << 16):
+        """Entry positions in [start, stop) with the best prior, best first.
+        Long ranges are taken a block at a time, so memory-mapped ranks are
+        never read in whole."""
+        best = np.empty(0, dtype=np.intp)
+        for lo in range(start, stop, block):
+            part_ranks = np.asarray(ranks[lo:min(lo + block, stop)])
+            if len(part_ranks) > k:
+                part = np.argpartition(part_ranks, k - 1)[:k]
+            else:
+                part = np.arange(len(part_ranks))
+            best = np.concatenate([best, lo + part])
+            best = best[np.argsort(ranks[best])[:k]]
+        return best
+
+    @classmethod
+    def _heavy_prefixes(cls, texts, ranks, k, threshold):
+        """Best completions of every prefix matching more than threshold entries"""
+        heavy = {}
+        stack = [('', 0, len(texts))]
+        while stack:
+            prefix, start, stop = stack.pop()
+            if stop - start <= threshold:
+                continue
+            heavy[prefix] = cls._best(ranks, start, stop, k)
+
+            # Split the range by the next character and descend into each child
+            pos = start
+            depth = len(prefix) + 1
+            while pos < stop:
+                if len(texts[pos]) < depth:
+                    pos += 1
+                    continue
+                child = texts[pos][:depth]
+                _, child_stop = cls._range(texts, child, pos, stop)
+                stack.append((child, pos, child_stop))
+                pos = child_stop
+        return heavy
+
+    def suggest(self, prefix, limit):
+        """Up to limit completions as (display text, kind) pairs, best prior first"""
+        prefix = normalize_text(prefix)
+        limit = min(limit, self.max_suggestions)
+        if not prefix or limit <= 0:
+            return []
+
+        i = bisect_left(self.heavy_keys, prefix)
+        if i < len(self.heavy_keys) and self.heavy_keys[i] == prefix:
+            positions = self.heavy_positions[i]
+            positions = positions[positions >= 0]
+        else:
+            start, stop = self._range(self.texts, prefix)
+            if start == stop:
+                return []
+            positions = self._best(self.ranks, start, stop, limit)
+
+        return [(self.display[pos], KIND_NAMES[self.kinds[pos]]) for pos in positions[:limit]]
+
+    def arrays(self):
+        arrays = {'kinds': self.kinds, 'counts': self.counts, 'newest': self.newest, 'ranks': self.ranks,
+                  'heavy_positions': self.heavy_positions, 'heavy_threshold': np.array(self.heavy_threshold)}
+        arrays.update(nested_arrays('texts', self.texts.arrays()))
+        arrays.update(nested_arrays('display', self.display.arrays()))
+        arrays.update(nested_arrays('heavy_keys', self.heavy_keys.arrays()))
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(
+            StringColumn.from_arrays(child_arrays('texts', arrays)),
+            StringColumn.from_arrays(child_arrays('display', arrays)),
+            arrays['kinds'],
+            arrays['counts'],
+            arrays['newest'],
+            arrays['ranks'],
+            StringColumn.from_arrays(child_arrays('heavy_keys', arrays)),
+            arrays['heavy_positions'],
+            int(arrays['heavy_threshold']),
+        )
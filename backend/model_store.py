@@ -0,0 +1,239 @@
+import contextlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections.abc import Mapping
+
+try:
+    import fcntl
+except ImportError:  # Windows: builds are not serialized across processes
+    fcntl = None
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+MODEL_ROOT = 'artifacts'
+MODEL_PREFIX = 'model-'
+MANIFEST_FILE = 'manifest.json'
+LOCK_FILE = '.build.lock'
+# Components mapped file by file as they are read rather than all at load time:
+# a streamed build stores the song metadata as many shards (see ShardedSongStore)
+LAZY_COMPONENTS = ('songs',)
+FORMAT_VERSION = 6  # 2: metadata and indexes stored as plain arrays instead of pickles; 3: appendable prefix index; 4: dictionary-encoded song metadata with JSON fragments; 5: audio features; 6: song metadata may be sharded (streamed builds)
+_lock_state = threading.local()  # build_lock() nesting depth of the current thread
+
+
+def model_directory(digest, root=MODEL_ROOT):
+    """Directory holding the model built from the catalog with this content hash"""
+    return os.path.join(root, MODEL_PREFIX + digest[:16])
+
+
+@contextlib.contextmanager
+def build_lock(root=MODEL_ROOT):
+    """Exclusive lock held while a model is built, so processes that find the
+    cache empty at the same time build it once and the rest load the result.
+    It is reentrant within a thread, so an ingest holding it can rebuild."""
+    if getattr(_lock_state, 'depth', 0):
+        _lock_state.depth += 1
+        try:
+            yield
+        finally:
+            _lock_state.depth -= 1
+        return
+
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, LOCK_FILE), 'w') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        _lock_state.depth = 1
+        try:
+            yield
+        finally:
+            _lock_state.depth = 0
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def save_csr(directory, name, matrix):
+    """Write a CSR matrix as separate data/indices/indptr arrays that can be memory-mapped"""
+    np.save(os.path.join(directory, f'{name}_data.npy'), matrix.data)
+    np.save(os.path.join(directory, f'{name}_indices.npy'), matrix.indices)
+    np.save(os.path.join(directory, f'{name}_indptr.npy'), matrix.indptr)
+
+
+def load_csr(directory, name, shape, mmap_mode='r'):
+    """Rebuild a CSR matrix over memory-mapped data/indices/indptr arrays"""
+    arrays = [np.load(os.path.join(directory, f'{name}_{part}.npy'), mmap_mode=mmap_mode)
+              for part in ('data', 'indices', 'indptr')]
+    matrix = sparse.csr_matrix(tuple(arrays), shape=tuple(shape), copy=False)
+    # Arrays were written from a canonical matrix; saying so stops scipy from
+    # trying to sort or deduplicate them in place on the read-only mapping
+    matrix.has_sorted_indices = True
+    matrix.has_canonical_format = True
+    return matrix
+
+
+def array_path(directory, name, key):
+    """File holding array key of component name, as save_arrays() names it"""
+    return os.path.join(directory, f'{name}__{key}.npy')
+
+
+def save_arrays(directory, name, arrays):
+    """Write a dict of arrays as {name}__{key}.npy files"""
+    for key, array in arrays.items():
+        np.save(array_path(directory, name, key), array, allow_pickle=False)
+
+
+def open_array(directory, name, key, dtype, shape):
+    """Writable memory-mapped array stored where save_arrays() would put it,
+    for arrays filled piece by piece"""
+    return np.lib.format.open_memmap(array_path(directory, name, key), mode='w+', dtype=dtype, shape=shape)
+
+
+class StoredArrays(Mapping):
+    """The arrays written by save_arrays under name, each memory-mapped only
+    when it is read. Every mapping holds a file descriptor, so a component
+    made of very many files is opened piece by piece instead of at once."""
+
+    def __init__(self, directory, name, mmap_mode='r'):
+        prefix = f'{name}__'
+        self.paths = {
+            filename[len(prefix):-len('.npy')]: os.path.join(directory, filename)
+            for filename in os.listdir(directory)
+            if filename.startswith(prefix) and filename.endswith('.npy')
+        }
+        self.mmap_mode = mmap_mode
+
+    def __getitem__(self, key):
+        return np.load(self.paths[key], mmap_mode=self.mmap_mode, allow_pickle=False)
+
+    def __contains__(self, key):
+        return key in self.paths
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def load_arrays(directory, name, mmap_mode='r'):
+    """Memory-map every array written by save_arrays under name"""
+    return dict(StoredArrays(directory, name, mmap_mode))
+
+
+def save_model(digest, tfidf, tfidf_matrix, tfidf_matrix_t, components, root=MODEL_ROOT, replace=False):
+    """Persist the fitted vectorizer, both CSR matrices and the other model
+    components (song metadata, lookup indexes), given as name -> dict of arrays.
+    An existing model for the same hash is kept unless replace is set."""
+    def write(directory):
+        save_vectorizer(directory, tfidf)
+        save_csr(directory, 'tfidf', tfidf_matrix)
+        save_csr(directory, 'tfidf_t', tfidf_matrix_t)
+        for name, arrays in components.items():
+            save_arrays(directory, name, arrays)
+        return tfidf_matrix.shape, tfidf_matrix.nnz, components
+
+    return write_model(digest, write, root, replace)
+
+
+def save_vectorizer(directory, tfidf):
+    np.save(os.path.join(directory, 'vocabulary.npy'), np.array(tfidf.get_feature_names_out(), dtype=str))
+    np.save(os.path.join(directory, 'idf.npy'), tfidf.idf_)
+
+
+def write_model(digest, write, root=MODEL_ROOT, replace=False):
+    """Create the model directory for this catalog hash by calling
+    write(directory), which writes the model files and returns (shape, nnz,
+    component names) of what it wrote.
+
+    Files are written to a temporary directory that is renamed into place
+    once complete, so a concurrent reader never sees a partial model. An
+    existing model for the same hash is kept unless replace is set."""
+    final_dir = model_directory(digest, root)
+    if os.path.exists(os.path.join(final_dir, MANIFEST_FILE)) and not replace:
+        return final_dir
+
+    os.makedirs(root, exist_ok=True)
+    tmp_dir = f'{final_dir}.tmp-{os.getpid()}'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    try:
+        shape, nnz, components = write(tmp_dir)
+
+        manifest = {
+            'format_version': FORMAT_VERSION,
+            'source_sha256': digest,
+            'shape': [int(size) for size in shape],
+            'nnz': int(nnz),
+            'components': sorted(components),
+            'built_at': time.time(),
+        }
+        # The manifest is written last; its presence marks the model as complete
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        if replace and os.path.exists(final_dir):
+            # Move the old model aside first; processes that mapped its files keep them
+            old_dir = f'{final_dir}.old-{os.getpid()}'
+            os.rename(final_dir, old_dir)
+            os.rename(tmp_dir, final_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        else:
+            os.rename(tmp_dir, final_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if os.path.exists(os.path.join(final_dir, MANIFEST_FILE)):
+            # Another worker finished the same model first
+            return final_dir
+        raise
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    prune_models(keep=final_dir, root=root)
+    return final_dir
+
+
+def load_model(digest, root=MODEL_ROOT):
+    """Load the persisted model for this catalog hash, memory-mapping every array.
+
+    Returns (tfidf, tfidf_matrix, tfidf_matrix_t, components) with components
+    as name -> dict of arrays (a StoredArrays for LAZY_COMPONENTS), or None
+    when no complete model exists for the hash."""
+    directory = model_directory(digest, root)
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('format_version') != FORMAT_VERSION or manifest.get('source_sha256') != digest:
+            return None
+
+        shape = manifest['shape']
+        terms = np.load(os.path.join(directory, 'vocabulary.npy'))
+        tfidf = TfidfVectorizer(stop_words='english', vocabulary={term: i for i, term in enumerate(terms.tolist())})
+        tfidf.idf_ = np.load(os.path.join(directory, 'idf.npy'))
+        tfidf_matrix = load_csr(directory, 'tfidf', shape)
+        tfidf_matrix_t = load_csr(directory, 'tfidf_t', shape[::-1])
+        components = {name: StoredArrays(directory, name) if name in LAZY_COMPONENTS else load_arrays(directory, name)
+                      for name in manifest['components']}
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Could not load cached model: {str(e)}")
+        return None
+
+    return tfidf, tfidf_matrix, tfidf_matrix_t, components
+
+
+def prune_models(keep, root=MODEL_ROOT):
+    """Remove models built from older versions of the catalog"""
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name.startswith(MODEL_PREFIX) and path != keep and '.tmp-' not in name and '.old-' not in name:
+            shutil.rmtree(path, ignore_errors=True)
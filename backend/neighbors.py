@@ -0,0 +1,219 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from parallel_build import StageTimer, resolve_workers
+from scoring import score_rows, top_k, transpose_matrix
+
+NEIGHBORS_DIR = 'artifacts'
+INDICES_FILE = 'neighbors_indices.npy'
+SCORES_FILE = 'neighbors_scores.npy'
+META_FILE = 'neighbors_meta.json'
+FORMAT_VERSION = 2  # 2: seed row excluded from its own neighbor list
+DEFAULT_K = 50
+DEFAULT_BLOCK_SIZE = 1024
+APPEND_BLOCK_SIZE = 128  # Appended rows scored per block; each block is dense over the whole catalog
+
+
+def file_digest(path):
+    """SHA-256 of a file's contents, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_neighbors(matrix, k=DEFAULT_K, block_size=DEFAULT_BLOCK_SIZE, workers=1):
+    """Top-k neighbors of every row (excluding the row itself), computed block
+    by block so only block_size x N similarities are ever held in memory.
+
+    With several workers the blocks are scored in a process pool, each worker
+    holding one block at a time, so peak memory grows to workers x
+    block_size x N similarities (plus a copy of the matrix per worker when
+    processes are not forked)."""
+    n_rows = matrix.shape[0]
+    k = min(k, n_rows - 1)
+    indices = np.empty((n_rows, k), dtype=np.int32)
+    scores = np.empty((n_rows, k), dtype=np.float32)
+    matrix_t = transpose_matrix(matrix)
+    starts = range(0, n_rows, block_size)
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=set_block_matrix,
+                                       initargs=(matrix, matrix_t, k))
+        blocks = executor.map(neighbor_block, starts, [block_size] * len(starts))
+    else:
+        executor = None
+        set_block_matrix(matrix, matrix_t, k)
+        blocks = map(neighbor_block, starts, [block_size] * len(starts))
+
+    try:
+        for start, block_indices, block_scores in blocks:
+            stop = start + len(block_indices)
+            indices[start:stop] = block_indices
+            scores[start:stop] = block_scores
+            print(f"Neighbors built for {stop}/{n_rows} rows")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        set_block_matrix(None, None, None)
+
+    return indices, scores
+
+
+# Matrix a process scores neighbor blocks of: set once per pool worker
+_block_matrix = None
+
+
+def set_block_matrix(matrix, matrix_t, k):
+    global _block_matrix
+    _block_matrix = (matrix, matrix_t, k) if matrix is not None else None
+
+
+def neighbor_block(start, block_size):
+    """(start, indices, scores) of the top-k lists of rows start..start+block_size"""
+    matrix, matrix_t, k = _block_matrix
+    stop = min(start + block_size, matrix.shape[0])
+    block = score_rows(matrix, matrix_t, np.arange(start, stop))
+    indices = np.empty((stop - start, k), dtype=np.int32)
+    scores = np.empty((stop - start, k), dtype=np.float32)
+    for offset, row in enumerate(block):
+        best = top_k(row, k, exclude=start + offset)
+        indices[offset] = best
+        scores[offset] = row[best]
+    return start, indices, scores
+
+
+def append_neighbors(indices, scores, matrix, matrix_t, first_row, block_size=APPEND_BLOCK_SIZE):
+    """Neighbor table extended to rows appended to the matrix from first_row on.
+
+    Appended rows are scored against the whole catalog for their own lists.
+    An existing row's list changes only if an appended row beats its current
+    k-th neighbor, so only those lists are merged; the rest are kept as is.
+    Returns (indices, scores, number of existing lists that changed)."""
+    n_rows = matrix.shape[0]
+    k = indices.shape[1]
+    new_indices = np.empty((n_rows - first_row, k), dtype=np.int32)
+    new_scores = np.empty((n_rows - first_row, k), dtype=np.float32)
+    kth_scores = np.asarray(scores[:, k - 1])
+    improvements = {}  # existing row -> [(score, appended row)]
+
+    for start in range(first_row, n_rows, block_size):
+        stop = min(start + block_size, n_rows)
+        block = score_rows(matrix, matrix_t, np.arange(start, stop))
+        for offset, row in enumerate(block):
+            best = top_k(row, k, exclude=start + offset)
+            new_indices[start - first_row + offset] = best
+            new_scores[start - first_row + offset] = row[best]
+
+        # Cosine is symmetric, so the block's first columns are the appended
+        # rows' scores as seen from each existing row. Ties never displace an
+        # existing neighbor, which always has the lower row id.
+        existing = block[:, :first_row].astype(np.float32)
+        offsets, rows = np.nonzero(existing > kth_scores)
+        for offset, row in zip(offsets, rows):
+            improvements.setdefault(row, []).append((existing[offset, row], start + offset))
+
+    indices = np.array(indices)
+    scores = np.array(scores)
+    for row, candidates in improvements.items():
+        candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+        candidate_scores = np.array([score for score, _ in candidates], dtype=np.float32)
+        # Each candidate goes after the existing neighbors scoring at least as much
+        positions = np.searchsorted(-scores[row], -candidate_scores, side='right')
+        indices[row] = np.insert(indices[row], positions, [candidate for _, candidate in candidates])[:k]
+        scores[row] = np.insert(scores[row], positions, candidate_scores)[:k]
+
+    indices = np.concatenate([indices, new_indices])
+    scores = np.concatenate([scores, new_scores])
+    return indices, scores, len(improvements)
+
+
+def save_neighbors(indices, scores, source_file, directory=NEIGHBORS_DIR, similarity='tfidf'):
+    """Write the neighbor arrays plus a sidecar recording which catalog and
+    similarity model ('tfidf' or 'svd') they describe.
+
+    Each file is written under a temporary name and renamed into place, so
+    processes that memory-mapped the previous arrays keep a valid mapping."""
+    os.makedirs(directory, exist_ok=True)
+    for filename, array in ((INDICES_FILE, indices), (SCORES_FILE, scores)):
+        tmp_path = os.path.join(directory, f'{filename}.tmp-{os.getpid()}.npy')
+        np.save(tmp_path, array)
+        os.replace(tmp_path, os.path.join(directory, filename))
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'source_file': os.path.basename(source_file),
+        'source_sha256': file_digest(source_file),
+        'n_rows': int(indices.shape[0]),
+        'k': int(indices.shape[1]),
+        'similarity': similarity,
+        'built_at': time.time(),
+    }
+    tmp_path = os.path.join(directory, f'{META_FILE}.tmp-{os.getpid()}')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, os.path.join(directory, META_FILE))
+
+
+def load_neighbors(source_digest, n_rows, directory=NEIGHBORS_DIR, similarity='tfidf'):
+    """Memory-map the neighbor arrays, or return None if missing or built
+    from a catalog other than the one with this SHA-256, or with another
+    similarity model"""
+    meta_path = os.path.join(directory, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    if meta.get('format_version') != FORMAT_VERSION:
+        print("Neighbor index format is outdated, falling back to live scoring")
+        return None
+
+    if meta.get('n_rows') != n_rows or meta.get('source_sha256') != source_digest:
+        print("Neighbor index is stale, falling back to live scoring")
+        return None
+
+    if meta.get('similarity', 'tfidf') != similarity:
+        print(f"Neighbor index was built for {meta.get('similarity', 'tfidf')} similarity, falling back to live scoring")
+        return None
+
+    try:
+        indices = np.load(os.path.join(directory, INDICES_FILE), mmap_mode='r')
+        scores = np.load(os.path.join(directory, SCORES_FILE), mmap_mode='r')
+    except (OSError, ValueError) as e:
+        print(f"Could not load neighbor index: {str(e)}")
+        return None
+
+    return indices, scores
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute top-K neighbors for the music catalog")
+    parser.add_argument('--k', type=int, default=DEFAULT_K,
+                        help="neighbors stored per track")
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE,
+                        help="rows scored per block")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes scoring blocks in parallel (0 = one per CPU)")
+    args = parser.parse_args()
+
+    timer = StageTimer()
+    with timer.stage('load model'):
+        import app
+    with timer.stage('neighbors'):
+        indices, scores = build_neighbors(app.model.vectors, args.k, args.block_size, resolve_workers(args.workers))
+    with timer.stage('save'):
+        save_neighbors(indices, scores, app.DATA_FILE, similarity=app.SIMILARITY_MODEL)
+    print(f"Saved {indices.shape[0]} x {indices.shape[1]} neighbor index to {NEIGHBORS_DIR}/")
+    print(f"Timings: {timer.summary()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import contextlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+DEFAULT_CHUNK_ROWS = 50000
+
+
+def resolve_workers(workers):
+    """Worker count to use: workers, or every CPU when it is 0 or less"""
+    return workers if workers > 0 else (os.cpu_count() or 1)
+
+
+class StageTimer:
+    """Wall-clock time of each named stage of a build, printed as it finishes"""
+
+    def __init__(self):
+        self.timings = {}  # stage name -> seconds, in order
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round(time.perf_counter() - started, 3)
+            print(f"Build stage '{name}' took {self.timings[name]:.2f}s")
+
+    def summary(self):
+        return ', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.timings.items())
+
+
+def chunk_counts(texts):
+    """Terms of a chunk of documents (sorted) and the chunk's term counts over them"""
+    counter = CountVectorizer(stop_words='english', dtype=np.float64)
+    try:
+        counts = counter.fit_transform(texts)
+    except ValueError:  # No terms in this chunk; another chunk may still have some
+        return np.array([], dtype=str), sparse.csr_matrix((len(texts), 0))
+    counts.sort_indices()
+    return counter.get_feature_names_out(), counts
+
+
+def fit_tfidf(texts, workers, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """Fit TfidfVectorizer(stop_words='english') and transform texts, with the
+    tokenizing done in row chunks across a process pool. Returns (tfidf,
+    matrix): the vocabulary and IDF a single fit_transform() would learn,
+    and the same rows up to floating-point rounding.
+
+    Each worker counts the terms of its chunk against a vocabulary of its
+    own. The chunk vocabularies are then merged into the sorted global one,
+    the chunks' column indices are remapped onto it, and the document
+    frequencies summed; IDF weighting and row normalization are single
+    vectorized passes over the stacked counts."""
+    texts = np.asarray(texts, dtype=object)
+    chunks = [texts[start:start + chunk_rows] for start in range(0, len(texts), chunk_rows)]
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+        counted = list(executor.map(chunk_counts, chunks))
+
+    terms = np.unique(np.concatenate([chunk_terms for chunk_terms, _ in counted]))
+    if not len(terms):
+        raise ValueError("empty vocabulary; perhaps the documents only contain stop words")
+    document_frequency = np.zeros(len(terms), dtype=np.int64)
+    blocks = []
+    for chunk_terms, counts in counted:
+        # Both vocabularies are sorted, so remapped indices stay sorted within each row
+        columns = np.searchsorted(terms, chunk_terms)
+        document_frequency[columns] += np.bincount(counts.indices, minlength=len(chunk_terms))
+        blocks.append(sparse.csr_matrix((counts.data, columns[counts.indices], counts.indptr),
+                                        shape=(counts.shape[0], len(terms))))
+    del counted
+
+    # Smoothed IDF, as TfidfTransformer computes it
+    idf = np.log((len(texts) + 1) / (document_frequency + 1.0)) + 1.0
+    matrix = sparse.vstack(blocks, format='csr')
+    matrix.data *= idf[matrix.indices]
+    return fitted_vectorizer(terms.tolist(), idf), normalize(matrix, norm='l2', copy=False)
+
+
+def fitted_vectorizer(terms, idf):
+    """TfidfVectorizer fitted to a vocabulary (sorted terms) and IDF weights"""
+    tfidf = TfidfVectorizer(stop_words='english', vocabulary={term: i for i, term in enumerate(terms)})
+    tfidf.idf_ = idf
+    return tfidf
@@ -0,0 +1,108 @@
+import os
+import threading
+import time
+
+
+class Reloader:
+    """Runs a reload function in a background thread, at most one at a time.
+
+    The function is expected to build the new state completely before
+    publishing it, so serving continues from the old state meanwhile."""
+
+    def __init__(self, reload_fn):
+        self.reload_fn = reload_fn
+        self._lock = threading.Lock()
+        self._thread = None
+        self._busy = False  # set under _lock from trigger() until the thread has no queued work
+        self._queued = None  # kwargs of a reload requested while another was running
+        self._watch_pid = None
+        self.reloads = 0
+        self.failures = 0
+        self.last_started = None
+        self.last_finished = None
+        self.last_error = None
+
+    def running(self):
+        return self._busy
+
+    def trigger(self, **kwargs):
+        """Start a reload, passing kwargs to the reload function. If one is already
+        running, another is queued to run after it (repeated requests merge into
+        that one). Returns True if the reload started now, False if it was queued."""
+        with self._lock:
+            if self._busy:
+                self._queued = {**(self._queued or {}), **kwargs}
+                return False
+            self._busy = True
+            self._thread = threading.Thread(target=self._run, args=(kwargs,), name='model-reload', daemon=True)
+            self._thread.start()
+            return True
+
+    def wait(self, timeout=None):
+        """Block until the running reload (if any) finishes"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self, kwargs):
+        while kwargs is not None:
+            self.last_started = time.time()
+            try:
+                self.reload_fn(**kwargs)
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                print(f"Reload failed, still serving the previous model: {str(e)}")
+            else:
+                self.reloads += 1
+                self.last_error = None
+            finally:
+                self.last_finished = time.time()
+
+            with self._lock:
+                kwargs, self._queued = self._queued, None
+                self._busy = kwargs is not None
+
+    def status(self):
+        return {
+            "running": self.running(),
+            "queued": self._queued is not None,
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "last_started": self.last_started,
+            "last_finished": self.last_finished,
+            "last_error": self.last_error,
+        }
+
+    def watch(self, path, interval):
+        """Poll path every interval seconds and reload after it changes.
+
+        A change is acted on only once the file's size and mtime have stayed
+        the same for one more interval, so a file that is still being written
+        is not loaded half-way. Threads do not survive fork(), so this is safe
+        to call again in a forked worker; it starts one watcher per process."""
+        if self._watch_pid == os.getpid():
+            return
+        self._watch_pid = os.getpid()
+        thread = threading.Thread(target=self._watch, args=(path, interval), name='catalog-watch', daemon=True)
+        thread.start()
+
+    def _watch(self, path, interval):
+        loaded = file_signature(path)
+        previous = loaded
+        while True:
+            time.sleep(interval)
+            current = file_signature(path)
+            if current != loaded and current == previous and current is not None:
+                self.trigger()
+                loaded = current
+            previous = current
+
+
+def file_signature(path):
+    """(mtime, size) of a file, or None if it does not exist"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
@@ -0,0 +1,89 @@
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+
+def prepare_matrix(tfidf_matrix):
+    """Return the TF-IDF matrix as L2-normalized CSR so a dot product is the cosine"""
+    return normalize(tfidf_matrix.tocsr(), norm='l2', copy=False)
+
+
+def transpose_matrix(matrix):
+    """CSR copy of the transposed matrix, so row-times-catalog products are
+    sparse-times-CSR (fast) rather than sparse-times-CSC. A dense matrix
+    (embedding vectors) is only viewed transposed; BLAS reads it in place."""
+    if not sparse.issparse(matrix):
+        return matrix.T
+    return matrix.T.tocsr()
+
+
+def dense_scores(product):
+    """Scores as an ndarray, whether the product was sparse (TF-IDF) or dense (embedding)"""
+    return product.toarray() if sparse.issparse(product) else np.asarray(product)
+
+
+def score_row(matrix, matrix_t, idx):
+    """Cosine similarity of catalog row idx against every row, as a dense 1-D array"""
+    # Sparse vector-matrix product: O(nnz) work, O(N) output, no N x N matrix;
+    # with embedding vectors it is a single GEMV
+    return dense_scores(matrix[idx:idx + 1].dot(matrix_t)).ravel()
+
+
+def score_rows(matrix, matrix_t, rows):
+    """Cosine similarities of several catalog rows against every row, one
+    matrix product (sparse, or a GEMM for embeddings) for all of them;
+    shape (len(rows), N)"""
+    return dense_scores(matrix[np.asarray(rows, dtype=np.intp)].dot(matrix_t))
+
+
+def centroid_query(matrix, rows, weights=None):
+    """L2-normalized weighted sum of several catalog rows, as a 1 x V row
+    (sparse for TF-IDF, dense for embeddings)"""
+    rows = np.asarray(rows, dtype=np.intp)
+    weights = np.ones(len(rows)) if weights is None else np.asarray(weights, dtype=np.float64)
+    if not sparse.issparse(matrix):
+        query = weights[np.newaxis, :].astype(matrix.dtype) @ matrix[rows]
+        return normalize(query, norm='l2', copy=False)
+    query = sparse.csr_matrix(weights[np.newaxis, :]).dot(matrix[rows])
+    return normalize(query, norm='l2', copy=False)
+
+
+def score_query(query, matrix_t):
+    """Cosine similarity of a normalized 1 x V query row against every catalog row"""
+    return dense_scores(query.dot(matrix_t)).ravel()
+
+
+def top_k(scores, k, exclude=None, mask=None):
+    """Indices of the k highest scores, best first, ties broken by lower index.
+    Rows listed in exclude (e.g. the seed song) are never returned, and when a
+    boolean mask is given only rows where it is True are considered."""
+    excluded = np.unique(np.asarray([] if exclude is None else exclude, dtype=np.intp).ravel())
+    if mask is not None:
+        # Select within the allowed rows only, so filtering happens before
+        # truncation and exactly k rows come back whenever k rows match
+        rows = np.flatnonzero(mask)
+        if len(excluded):
+            rows = rows[~np.isin(rows, excluded)]
+        return rows[top_k(scores[rows], k)]
+
+    n = scores.shape[0]
+    wanted = min(k, n - len(excluded))
+    k = wanted + len(excluded)
+    if wanted <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    if k < n:
+        # Partial selection finds the k-th largest score; of the rows tied with
+        # it, the lowest indices are kept so results match a stable full sort
+        kth = scores[np.argpartition(-scores, k - 1)[k - 1]]
+        above = np.flatnonzero(scores > kth)
+        tied = np.flatnonzero(scores == kth)[:k - len(above)]
+        candidates = np.concatenate((above, tied))
+    else:
+        candidates = np.arange(n)
+
+    order = np.lexsort((candidates, -scores[candidates]))
+    ranked = candidates[order[:k]]
+    if len(excluded):
+        ranked = ranked[~np.isin(ranked, excluded)]
+    return ranked[:wanted]
@@ -0,0 +1,365 @@
+import json
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+
+from cache import LRUCache
+from catalog import text_values
+from strings import StringColumn, CategoryColumn, integer_dtype, nested_arrays, child_arrays
+
+# Text columns whose distinct values are at most this share of the rows are dictionary-encoded
+CATEGORY_MAX_DISTINCT = 0.5
+# Shards of a ShardedSongStore kept open at once; each holds one file descriptor per array
+MAX_OPEN_SHARDS = 8
+
+
+def encode_record(record):
+    """One song as compact JSON with sorted keys, as jsonify writes it"""
+    return json.dumps(record, sort_keys=True, separators=(',', ':'))
+
+
+class EncodedRows:
+    """Songs already encoded as JSON objects, spliced into a response as-is"""
+
+    def __init__(self, fragments):
+        self.fragments = fragments  # list of JSON object strings
+
+    def __len__(self):
+        return len(self.fragments)
+
+    def to_json(self):
+        return '[' + ','.join(self.fragments) + ']'
+
+
+def encode_response(payload):
+    """JSON text for a response payload that may contain EncodedRows.
+    Output matches jsonify: compact separators, sorted keys, ASCII only."""
+    if isinstance(payload, EncodedRows):
+        return payload.to_json()
+    if isinstance(payload, dict):
+        items = sorted(payload.items())
+        return '{' + ','.join(f'{json.dumps(str(key))}:{encode_response(value)}' for key, value in items) + '}'
+    if isinstance(payload, (list, tuple)):
+        return '[' + ','.join(encode_response(value) for value in payload) + ']'
+    return json.dumps(payload, separators=(',', ':'))
+
+
+def integer_values(values, is_missing):
+    """Float values as the narrowest integer array (0 where missing), or None if
+    some value is not a whole number"""
+    present = values[~is_missing]
+    if len(present) and (not np.all(np.isfinite(present)) or np.any(present != np.round(present))
+                         or np.abs(present).max() >= 2 ** 53):
+        return None
+    integers = np.where(is_missing, 0, values).astype(np.int64)
+    return integers.astype(integer_dtype(integers))
+
+
+class SongStore:
+    """Read-only song metadata held in flat NumPy arrays instead of a DataFrame.
+
+    Text columns that repeat are dictionary-encoded CategoryColumns, other
+    text columns are StringColumns, and whole-number columns (years) use the
+    narrowest integer type, with masks for missing values. Every array can be
+    memory-mapped and shared between workers. For the field sets responses
+    use, each song is also kept pre-encoded as a JSON object, so a response
+    is assembled by joining strings instead of building dicts."""
+
+    def __init__(self, names, columns, missing, fragments=None):
+        self.names = list(names)
+        self.columns = columns  # name -> StringColumn, CategoryColumn or ndarray
+        self.missing = missing  # name -> bool ndarray for StringColumns and integer columns with gaps
+        self.fragments = fragments or {}  # sorted field tuple -> StringColumn of JSON objects
+
+    @classmethod
+    def from_frame(cls, frame):
+        """Build a store from a DataFrame, keeping its column order"""
+        columns = {}
+        missing = {}
+        for name in frame.columns:
+            series = frame[name]
+            is_missing = series.isna().to_numpy()
+            if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+                values = series.to_numpy()
+                if values.dtype.kind in 'iu':
+                    columns[name] = values.astype(integer_dtype(values))
+                    continue
+                # Floats, or nullable integers with gaps (e.g. from a Parquet catalog)
+                values = series.astype(np.float64).to_numpy()
+                integers = integer_values(values, is_missing)
+                if integers is None:
+                    columns[name] = values
+                    continue
+                columns[name] = integers
+                if is_missing.any():
+                    missing[name] = is_missing
+                continue
+
+            texts = text_values(series)
+            codes, categories = pd.factorize(texts)
+            if len(categories) <= CATEGORY_MAX_DISTINCT * len(series):
+                codes[is_missing] = -1
+                columns[name] = CategoryColumn.from_codes(codes, list(categories))
+                continue
+
+            columns[name] = StringColumn.from_strings(texts)
+            if is_missing.any():
+                missing[name] = is_missing
+        return cls(frame.columns, columns, missing)
+
+    def __len__(self):
+        first = self.columns[self.names[0]]
+        return len(first)
+
+    @property
+    def shape(self):
+        return (len(self), len(self.names))
+
+    def column_values(self, name, rows):
+        """Python values of one column for the given rows (None where missing)"""
+        column = self.columns[name]
+        if isinstance(column, np.ndarray):
+            values = column[np.asarray(rows, dtype=np.intp)].tolist()
+            if column.dtype.kind == 'f':
+                values = [None if value != value else value for value in values]  # NaN -> None
+        else:
+            values = column.take(rows)
+
+        is_missing = self.missing.get(name)
+        if is_missing is not None:
+            values = [None if is_missing[row] else value for row, value in zip(rows, values)]
+        return values
+
+    def records(self, rows, fields=None):
+        """One dict per row, like DataFrame.to_dict('records') on the same rows"""
+        fields = self.names if fields is None else fields
+        rows = [int(row) for row in rows]
+        values = [self.column_values(name, rows) for name in fields]
+        return [dict(zip(fields, row_values)) for row_values in zip(*values)]
+
+    def encoded_rows(self, rows, fields=None):
+        """The rows as EncodedRows, taken from the pre-encoded fragments when
+        this field set has them and encoded on the spot otherwise"""
+        fields = self.names if fields is None else fields
+        fragments = self.fragments.get(tuple(sorted(fields)))
+        if fragments is not None:
+            return EncodedRows(fragments.take([int(row) for row in rows]))
+        return EncodedRows([encode_record(record) for record in self.records(rows, fields)])
+
+    def with_fragments(self, fields=None):
+        """New store that also keeps every song pre-encoded for this field set"""
+        fields = self.names if fields is None else fields
+        key = tuple(sorted(fields))
+        if key in self.fragments:
+            return self
+        encoded = [encode_record(record) for record in self.records(range(len(self)), fields)]
+        return SongStore(self.names, self.columns, self.missing,
+                         {**self.fragments, key: StringColumn.from_strings(encoded)})
+
+    def append(self, frame):
+        """New store with the rows of frame added at the end. Columns frame
+        lacks are left empty for the new rows; extra columns are ignored."""
+        columns = {}
+        missing = {}
+        for name in self.names:
+            column = self.columns[name]
+            if name in frame.columns:
+                series = frame[name]
+            else:
+                series = pd.Series([None] * len(frame), index=frame.index, dtype=object)
+            is_missing = series.isna().to_numpy()
+            old_missing = self.missing.get(name)
+
+            if isinstance(column, np.ndarray):
+                values = pd.to_numeric(series, errors='coerce').astype(np.float64).to_numpy()
+                is_missing = np.isnan(values)
+                integers = integer_values(values, is_missing) if column.dtype.kind in 'iu' else None
+                if integers is None:
+                    # New fractional values turn an integer column back into floats with NaN gaps
+                    if column.dtype.kind in 'iu':
+                        column = column.astype(np.float64)
+                        if old_missing is not None:
+                            column[old_missing] = np.nan
+                    columns[name] = np.concatenate([column, values])
+                    continue
+                dtype = np.promote_types(column.dtype, integers.dtype)
+                columns[name] = np.concatenate([column.astype(dtype), integers.astype(dtype)])
+            elif isinstance(column, CategoryColumn):
+                columns[name] = column.append([None if gap else value
+                                               for gap, value in zip(is_missing, text_values(series))])
+                continue
+            else:
+                columns[name] = column.append(text_values(series))
+
+            if old_missing is not None or is_missing.any():
+                if old_missing is None:
+                    old_missing = np.zeros(len(self), dtype=bool)
+                missing[name] = np.concatenate([old_missing, is_missing])
+
+        store = SongStore(self.names, columns, missing)
+        new_rows = range(len(self), len(store))
+        fragments = {}
+        for key, encoded in self.fragments.items():
+            added = [encode_record(record) for record in store.records(new_rows, list(key))]
+            fragments[key] = encoded.append(added)
+        store.fragments = fragments
+        return store
+
+    def arrays(self):
+        """Backing arrays, for persisting the store"""
+        arrays = {'names': np.array(self.names, dtype=str)}
+        for i, name in enumerate(self.names):
+            column = self.columns[name]
+            if isinstance(column, np.ndarray):
+                arrays[f'col{i}.values'] = column
+            else:
+                arrays.update(nested_arrays(f'col{i}', column.arrays()))
+            if name in self.missing:
+                arrays[f'col{i}.missing'] = self.missing[name]
+        for i, (key, encoded) in enumerate(self.fragments.items()):
+            arrays[f'json{i}.fields'] = np.array(key, dtype=str)
+            arrays.update(nested_arrays(f'json{i}', encoded.arrays()))
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        names = arrays['names'].tolist()
+        columns = {}
+        missing = {}
+        for i, name in enumerate(names):
+            column_arrays = child_arrays(f'col{i}', arrays)
+            if 'values' in column_arrays:
+                columns[name] = column_arrays['values']
+            elif 'codes' in column_arrays:
+                columns[name] = CategoryColumn.from_arrays(column_arrays)
+            else:
+                columns[name] = StringColumn.from_arrays(column_arrays)
+            if 'missing' in column_arrays:
+                missing[name] = column_arrays['missing']
+        fragments = {}
+        i = 0
+        while f'json{i}.fields' in arrays:
+            encoded_arrays = child_arrays(f'json{i}', arrays)
+            fragments[tuple(encoded_arrays['fields'].tolist())] = StringColumn.from_arrays(encoded_arrays)
+            i += 1
+        return cls(names, columns, missing, fragments)
+
+
+class ShardedSongStore:
+    """Song metadata split into consecutive SongStore shards, for catalogs
+    built in chunks.
+
+    Shards are restored from their (memory-mapped) arrays on first access,
+    so only the shards responses actually touch are ever opened, and at most
+    max_open of them stay open (least recently used first out). Offers the
+    same read interface as SongStore; appended rows go into the last shard."""
+
+    def __init__(self, names, shard_rows, load_shard, max_open=MAX_OPEN_SHARDS):
+        self.names = list(names)
+        self.shard_rows = np.asarray(shard_rows, dtype=np.int64)
+        self.bounds = np.concatenate([[0], np.cumsum(self.shard_rows)])  # first row of each shard, then the total
+        self.max_open = max_open
+        self._load_shard = load_shard  # shard number -> SongStore
+        self._shards = LRUCache(maxsize=max_open, ttl=0)
+
+    def shard(self, number):
+        store = self._shards.get(number)
+        if store is None:
+            store = self._load_shard(number)
+            self._shards.put(number, store)
+        return store
+
+    def __len__(self):
+        return int(self.bounds[-1])
+
+    @property
+    def shape(self):
+        return (len(self), len(self.names))
+
+    def _split(self, rows):
+        """(shard number, positions in rows, local rows) for each shard the rows fall in"""
+        rows = np.asarray(rows, dtype=np.int64)
+        shard_of = np.searchsorted(self.bounds, rows, side='right') - 1
+        for number in np.unique(shard_of):
+            positions = np.flatnonzero(shard_of == number)
+            yield int(number), positions, rows[positions] - self.bounds[number]
+
+    def _gather(self, rows, fetch):
+        """fetch(shard store, local rows) for every shard, reassembled in the order of rows"""
+        values = [None] * len(rows)
+        for number, positions, local in self._split(rows):
+            for position, value in zip(positions, fetch(self.shard(number), local)):
+                values[position] = value
+        return values
+
+    def column_values(self, name, rows):
+        return self._gather(rows, lambda store, local: store.column_values(name, local))
+
+    def records(self, rows, fields=None):
+        return self._gather(rows, lambda store, local: store.records(local, fields))
+
+    def encoded_rows(self, rows, fields=None):
+        return EncodedRows(self._gather(rows, lambda store, local: store.encoded_rows(local, fields).fragments))
+
+    def with_fragments(self, fields=None):
+        load_shard = self.shard
+        return ShardedSongStore(self.names, self.shard_rows, lambda number: load_shard(number).with_fragments(fields),
+                                self.max_open)
+
+    def append(self, frame):
+        """New store with the rows of frame added to the last shard; the
+        other shards are still loaded on demand"""
+        last = len(self.shard_rows) - 1
+        tail = self.shard(last).append(frame)
+        load_shard = self._load_shard
+        shard_rows = np.concatenate([self.shard_rows[:last], [len(tail)]])
+        return ShardedSongStore(self.names, shard_rows, lambda number: tail if number == last else load_shard(number),
+                                self.max_open)
+
+    def arrays(self):
+        """Backing arrays of every shard, for persisting the store. They are
+        read one shard at a time as the mapping is iterated."""
+        return ShardArrays(self)
+
+    @classmethod
+    def from_arrays(cls, arrays, max_open=MAX_OPEN_SHARDS):
+        return cls(arrays['names'].tolist(), arrays['shard_rows'],
+                   lambda number: SongStore.from_arrays(child_arrays(f'shard{number}', arrays)), max_open)
+
+
+class ShardArrays(Mapping):
+    """ShardedSongStore.arrays(): the store's arrays under the keys
+    nested_arrays(f'shard{n}', ...) gives them, fetched from the shard when read"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, key):
+        if key == 'names':
+            return np.array(self.store.names, dtype=str)
+        if key == 'shard_rows':
+            return self.store.shard_rows
+        prefix, _, rest = key.partition('.')
+        if not (prefix.startswith('shard') and prefix[len('shard'):].isdigit()):
+            raise KeyError(key)
+        number = int(prefix[len('shard'):])
+        if number >= len(self.store.shard_rows):
+            raise KeyError(key)
+        return self.store.shard(number).arrays()[rest]
+
+    def __iter__(self):
+        yield 'names'
+        yield 'shard_rows'
+        for number in range(len(self.store.shard_rows)):
+            yield from nested_arrays(f'shard{number}', self.store.shard(number).arrays())
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def restore_song_store(arrays, max_open_shards=MAX_OPEN_SHARDS):
+    """SongStore or ShardedSongStore from the arrays either one persisted"""
+    if 'shard_rows' in arrays:
+        return ShardedSongStore.from_arrays(arrays, max_open_shards)
+    return SongStore.from_arrays(arrays)
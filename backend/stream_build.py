@@ -0,0 +1,530 @@
+import heapq
+import itertools
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import CountVectorizer
+
+from audio_features import AUDIO_FEATURE_COLUMNS, FeatureMatrix
+from embedding import Embedding, blockwise_components, embedding_dims
+from catalog import text_values
+from facets import build_year_array
+from lookup import PrefixIndex, TrigramIndex
+from model_store import array_path, load_arrays, open_array, save_arrays
+from parallel_build import fitted_vectorizer
+from scoring import prepare_matrix
+from strings import StringColumn, nested_arrays
+
+# Out-of-core model build. The catalog is read as a stream of row chunks
+# (twice for the TF-IDF matrix: once to learn the vocabulary, once to
+# vectorize), and every chunk's CSR rows are written straight into
+# preallocated memory-mapped .npy files, so memory holds one chunk plus
+# per-term arrays rather than the whole catalog.
+#
+# The lookup indexes are built the same way. Each chunk's share of an index
+# is built in memory and written out; structures ordered across the whole
+# catalog (title order, typeahead names) are sorted runs merged from disk,
+# and posting lists are placed by counting sort.
+
+RUN_READ_ROWS = 1 << 16  # Rows decoded at a time across all runs of a merge
+
+
+def count_terms(text_chunks):
+    """First pass over the catalog's feature text, chunk by chunk.
+
+    Returns (terms, document_frequency, n_rows, nnz): the sorted vocabulary
+    TfidfVectorizer(stop_words='english') would learn, how many rows contain
+    each term, and the row and non-zero counts of the TF-IDF matrix."""
+    terms = np.array([], dtype=str)
+    document_frequency = np.zeros(0, dtype=np.int64)
+    n_rows = nnz = 0
+    for texts in text_chunks:
+        n_rows += len(texts)
+        counter = CountVectorizer(stop_words='english', binary=True)
+        try:
+            counts = counter.fit_transform(texts)
+        except ValueError:  # No terms in this chunk
+            continue
+        # Without document-frequency cut-offs every term of a chunk is kept,
+        # so its non-zeros are exactly the full model's non-zeros for these rows
+        nnz += counts.nnz
+        merged, inverse = np.unique(np.concatenate([terms, counter.get_feature_names_out()]), return_inverse=True)
+        chunk_frequency = np.bincount(counts.indices, minlength=counts.shape[1])
+        frequency = np.bincount(inverse, weights=np.concatenate([document_frequency, chunk_frequency]),
+                                minlength=len(merged))
+        terms, document_frequency = merged, frequency.astype(np.int64)
+    if not len(terms):
+        raise ValueError("empty vocabulary; perhaps the documents only contain stop words")
+    return terms, document_frequency, n_rows, nnz
+
+
+def write_embedding(directory, matrix, dims, chunk_rows):
+    """Fit the svd embedding of the TF-IDF matrix written by write_tfidf()
+    (memory-mapped), chunk_rows rows at a time, and write it as the
+    'embedding' component Embedding.arrays() stores. The song vectors are
+    projected a chunk at a time into a memory-mapped array."""
+    dims = embedding_dims(matrix.shape, dims)
+    print(f"Fitting {dims}-dimensional SVD embedding in chunks of {chunk_rows} rows...")
+    embedding = Embedding(None, blockwise_components(matrix, dims, chunk_rows))
+    vectors = open_array(directory, 'embedding', 'vectors', np.float32, (matrix.shape[0], dims))
+    for start in range(0, matrix.shape[0], chunk_rows):
+        vectors[start:start + chunk_rows] = embedding.project(matrix[start:start + chunk_rows])
+    vectors.flush()
+    save_arrays(directory, 'embedding', {'components': embedding.components})
+
+
+def open_csr_files(directory, name, shape, nnz, data_dtype, index_dtype):
+    """Writable memory-mapped data/indices/indptr files for a CSR matrix,
+    laid out as model_store.save_csr() writes them"""
+    def open_array(part, dtype, length):
+        return np.lib.format.open_memmap(os.path.join(directory, f'{name}_{part}.npy'), mode='w+',
+                                         dtype=dtype, shape=(length,))
+    return (open_array('data', data_dtype, nnz), open_array('indices', index_dtype, nnz),
+            open_array('indptr', index_dtype, shape[0] + 1))
+
+
+def write_tfidf(directory, text_chunks, terms, document_frequency, n_rows, nnz):
+    """Second pass: vectorize each chunk and write its rows into the TF-IDF
+    matrix and its transpose on disk ('tfidf' and 'tfidf_t', as save_csr()
+    names them). Returns the fitted vectorizer.
+
+    The transpose is filled by counting sort: every column's length is its
+    document frequency, known from the first pass, and each chunk's entries
+    are placed after those of earlier chunks, so columns come out with
+    sorted row indices without holding the matrix in memory."""
+    n_terms = len(terms)
+    # Smoothed IDF, as TfidfTransformer computes it
+    idf = np.log((n_rows + 1) / (document_frequency + 1.0)) + 1.0
+    tfidf = fitted_vectorizer(terms.tolist(), idf)
+
+    index_dtype = np.int32 if max(nnz, n_rows, n_terms) < np.iinfo(np.int32).max else np.int64
+    data, indices, indptr = open_csr_files(directory, 'tfidf', (n_rows, n_terms), nnz, np.float64, index_dtype)
+    data_t, indices_t, indptr_t = open_csr_files(directory, 'tfidf_t', (n_terms, n_rows), nnz, np.float64,
+                                                 index_dtype)
+    indptr_t[0] = 0
+    np.cumsum(document_frequency, out=indptr_t[1:])
+    cursor = np.array(indptr_t[:-1], dtype=np.int64)  # next free slot of each column of the transpose
+
+    row = position = 0
+    indptr[0] = 0
+    for texts in text_chunks:
+        block = prepare_matrix(tfidf.transform(texts))
+        block.sort_indices()
+        stop = position + block.nnz
+        data[position:stop] = block.data
+        indices[position:stop] = block.indices
+        indptr[row + 1:row + 1 + block.shape[0]] = block.indptr[1:] + position
+
+        columns = block.tocsc()
+        counts = np.diff(columns.indptr)
+        slots = np.repeat(cursor - columns.indptr[:-1], counts) + np.arange(columns.nnz)
+        data_t[slots] = columns.data
+        indices_t[slots] = columns.indices + row
+        cursor += counts
+
+        row += block.shape[0]
+        position = stop
+        print(f"Vectorized {row}/{n_rows} rows")
+
+    for array in (data, indices, indptr, data_t, indices_t, indptr_t):
+        array.flush()
+    return tfidf
+
+
+class ArrayWriter:
+    """1-D .npy file written by appending blocks, for arrays whose length is
+    only known at the end. Blocks go to a side file, which is copied in
+    behind the header on close()."""
+
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self._part = open(f'{path}.part', 'wb')
+
+    def append(self, values):
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        values.tofile(self._part)
+        self.length += len(values)
+
+    def close(self):
+        self._part.close()
+        header = {'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False,
+                  'shape': (self.length,)}
+        with open(self.path, 'wb') as out, open(f'{self.path}.part', 'rb') as part:
+            np.lib.format.write_array_header_1_0(out, header)
+            shutil.copyfileobj(part, out, 1 << 24)
+        os.remove(f'{self.path}.part')
+
+
+class StringWriter:
+    """StringColumn arrays written by appending strings, under the keys
+    nested_arrays(prefix, ...) gives them in component name"""
+
+    def __init__(self, directory, name, prefix):
+        self.buffer = ArrayWriter(array_path(directory, name, f'{prefix}.buffer'), np.uint8)
+        self.offsets = ArrayWriter(array_path(directory, name, f'{prefix}.offsets'), np.int64)
+        self.offsets.append([0])
+        self.size = 0
+
+    def append_column(self, column):
+        self.buffer.append(column.buffer)
+        self.offsets.append(column.offsets[1:] + self.size)
+        self.size += int(column.offsets[-1])
+
+    def append(self, strings):
+        self.append_column(StringColumn.from_strings(strings))
+
+    def close(self):
+        self.buffer.close()
+        self.offsets.close()
+
+
+def save_run(temp, name, number, arrays):
+    """Store one chunk's sorted run in its own directory"""
+    directory = os.path.join(temp, f'{name}-{number}')
+    os.makedirs(directory)
+    save_arrays(directory, 'run', arrays)
+    return directory
+
+
+def load_run(directory):
+    return load_arrays(directory, 'run')
+
+
+def iter_strings(column, start=0, stop=None, block=RUN_READ_ROWS):
+    """Decoded strings of a (memory-mapped) StringColumn, a block at a time"""
+    stop = len(column) if stop is None else stop
+    for block_start in range(start, stop, block):
+        block_stop = min(block_start + block, stop)
+        offsets = column.offsets[block_start:block_stop + 1]
+        data = column.buffer[offsets[0]:offsets[-1]].tobytes()
+        offsets = (offsets - offsets[0]).tolist()
+        yield from (data[a:b].decode('utf-8') for a, b in zip(offsets, offsets[1:]))
+
+
+def write_blocks(out, values, block=RUN_READ_ROWS):
+    """Fill a preallocated array from an iterator of scalars, a block at a time"""
+    position = 0
+    while True:
+        chunk = np.fromiter(itertools.islice(values, block), dtype=out.dtype)
+        if not len(chunk):
+            return position
+        out[position:position + len(chunk)] = chunk
+        position += len(chunk)
+
+
+class TrigramWriter:
+    """TrigramIndex arrays written chunk by chunk. The normalized texts are
+    appended as they come; each chunk's posting lists are kept as a run, and
+    at the end placed into the catalog-wide lists by counting sort, with the
+    list lengths summed per trigram."""
+
+    def __init__(self, directory, name, temp):
+        self.directory = directory
+        self.name = name
+        self.temp = temp
+        self.texts = StringWriter(directory, name, 'texts')
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.runs = []
+
+    def add(self, index, first_row):
+        """Add a TrigramIndex over the chunk starting at first_row"""
+        self.texts.append_column(index.texts)
+        counts = np.diff(index.offsets)
+        keys = np.union1d(self.keys, index.keys)
+        merged = np.zeros(len(keys), dtype=np.int64)
+        merged[np.searchsorted(keys, self.keys)] += self.counts
+        merged[np.searchsorted(keys, index.keys)] += counts
+        self.keys, self.counts = keys, merged
+        self.runs.append(save_run(self.temp, self.name, len(self.runs),
+                                  {'keys': index.keys, 'counts': counts, 'rows': index.rows + first_row}))
+
+    def close(self):
+        self.texts.close()
+        np.save(array_path(self.directory, self.name, 'keys'), self.keys)
+        offsets = open_array(self.directory, self.name, 'offsets', np.int64, (len(self.keys) + 1,))
+        offsets[0] = 0
+        np.cumsum(self.counts, out=offsets[1:])
+        rows = open_array(self.directory, self.name, 'rows', np.int32, (int(offsets[-1]),))
+        # Chunks come in row order, so each chunk's postings go after those of earlier chunks
+        cursor = np.array(offsets[:-1])
+        for directory in self.runs:
+            run = load_run(directory)
+            positions = np.searchsorted(self.keys, run['keys'])
+            counts = np.asarray(run['counts'])
+            starts = np.cumsum(counts) - counts
+            rows[np.repeat(cursor[positions] - starts, counts) + np.arange(counts.sum())] = run['rows']
+            cursor[positions] += counts
+        offsets.flush()
+        rows.flush()
+
+
+class TitleOrderWriter:
+    """TitleIndex order (rows by normalized title, then row) by external merge
+    sort: each chunk is sorted into a run, and the runs are merged from disk"""
+
+    def __init__(self, directory, temp):
+        self.directory = directory
+        self.temp = temp
+        self.runs = []
+
+    def add(self, titles, first_row):
+        """Add the normalized titles (StringColumn) of the chunk starting at first_row"""
+        texts = titles.to_list()
+        order = sorted(range(len(texts)), key=lambda row: (texts[row], row))
+        arrays = nested_arrays('texts', StringColumn.from_strings([texts[row] for row in order]).arrays())
+        arrays['rows'] = np.array(order, dtype=np.int64) + first_row
+        self.runs.append(save_run(self.temp, 'title_order', len(self.runs), arrays))
+
+    def close(self, n_rows):
+        block = max(64, RUN_READ_ROWS // max(len(self.runs), 1))
+
+        def entries(directory):
+            run = load_run(directory)
+            column = StringColumn(run['texts.buffer'], run['texts.offsets'])
+            return zip(iter_strings(column, block=block), run['rows'].tolist())
+
+        order = open_array(self.directory, 'title_index', 'order', np.int32, (n_rows,))
+        write_blocks(order, (row for _, row in heapq.merge(*(entries(run) for run in self.runs))))
+        order.flush()
+
+
+class PrefixWriter:
+    """PrefixIndex arrays by external merge sort. Each chunk's names are
+    aggregated (PrefixIndex._aggregate) into a run sorted by (name, kind);
+    merging the runs sums each name's track counts across chunks. The prior
+    ranks are then assigned by counting sort over (count, newest year), and
+    the heavy prefixes computed over the memory-mapped result."""
+
+    def __init__(self, directory, temp, max_suggestions, heavy_threshold=256):
+        self.directory = directory
+        self.temp = temp
+        self.max_suggestions = max_suggestions
+        self.heavy_threshold = heavy_threshold
+        self.runs = []
+
+    def add(self, titles, artists, years):
+        entries = PrefixIndex._aggregate(titles, artists, years)
+        keys = sorted(entries)
+        arrays = nested_arrays('texts', StringColumn.from_strings([key for key, _ in keys]).arrays())
+        arrays.update(nested_arrays('display', StringColumn.from_strings([entries[key][0] for key in keys]).arrays()))
+        arrays['kinds'] = np.array([kind for _, kind in keys], dtype=np.int8)
+        arrays['counts'] = np.array([entries[key][1] for key in keys], dtype=np.int64)
+        arrays['newest'] = np.array([entries[key][2] for key in keys], dtype=np.int64)
+        self.runs.append(save_run(self.temp, 'suggest', len(self.runs), arrays))
+
+    def close(self):
+        name = 'suggest_index'
+        block = max(64, RUN_READ_ROWS // max(len(self.runs), 1))
+
+        def entries(number, directory):
+            run = load_run(directory)
+            texts = iter_strings(StringColumn(run['texts.buffer'], run['texts.offsets']), block=block)
+            display = iter_strings(StringColumn(run['display.buffer'], run['display.offsets']), block=block)
+            # The run number breaks ties, so the earliest chunk's display name is kept
+            return zip(texts, run['kinds'].tolist(), itertools.repeat(number), display,
+                       run['counts'].tolist(), run['newest'].tolist())
+
+        texts = StringWriter(self.directory, name, 'texts')
+        display = StringWriter(self.directory, name, 'display')
+        kinds = ArrayWriter(array_path(self.directory, name, 'kinds'), np.int8)
+        counts = ArrayWriter(array_path(self.directory, name, 'counts'), np.int32)
+        newest = ArrayWriter(array_path(self.directory, name, 'newest'), np.int32)
+        merged = heapq.merge(*(entries(number, run) for number, run in enumerate(self.runs)))
+        grouped = itertools.groupby(merged, key=lambda entry: (entry[0], entry[1]))
+        while True:
+            batch = []
+            for (key, kind), group in itertools.islice(grouped, RUN_READ_ROWS):
+                group = list(group)
+                batch.append((key, kind, group[0][3], sum(entry[4] for entry in group),
+                              max(entry[5] for entry in group)))
+            if not batch:
+                break
+            texts.append([entry[0] for entry in batch])
+            kinds.append([entry[1] for entry in batch])
+            display.append([entry[2] for entry in batch])
+            counts.append([entry[3] for entry in batch])
+            newest.append([entry[4] for entry in batch])
+        for writer in (texts, display, kinds, counts, newest):
+            writer.close()
+
+        arrays = load_arrays(self.directory, name)
+        ranks = open_array(self.directory, name, 'ranks', np.int32, (len(arrays['kinds']),))
+        prior_ranks(arrays['counts'], arrays['newest'], ranks)
+        ranks.flush()
+        heavy_keys, heavy_positions = PrefixIndex.heavy_completions(
+            StringColumn(arrays['texts.buffer'], arrays['texts.offsets']), ranks,
+            self.max_suggestions, self.heavy_threshold)
+        save_arrays(self.directory, name, {'heavy_positions': heavy_positions,
+                                           'heavy_threshold': np.array(self.heavy_threshold),
+                                           **nested_arrays('heavy_keys', heavy_keys.arrays())})
+
+
+def prior_ranks(counts, newest, out, block=RUN_READ_ROWS):
+    """PrefixIndex prior ranks (most tracks first, then newest, then position)
+    by counting sort: the rank of an entry is the number of entries in better
+    (count, newest) buckets plus those before it in its own"""
+    def bucket_keys(start):
+        stop = min(start + block, len(counts))
+        # Ascending keys are descending (count, newest)
+        return -((np.asarray(counts[start:stop], dtype=np.int64) << 32) | np.asarray(newest[start:stop], dtype=np.uint32))
+
+    buckets = np.zeros(0, dtype=np.int64)
+    sizes = np.zeros(0, dtype=np.int64)
+    for start in range(0, len(counts), block):
+        keys, block_sizes = np.unique(bucket_keys(start), return_counts=True)
+        merged = np.union1d(buckets, keys)
+        merged_sizes = np.zeros(len(merged), dtype=np.int64)
+        merged_sizes[np.searchsorted(merged, buckets)] += sizes
+        merged_sizes[np.searchsorted(merged, keys)] += block_sizes
+        buckets, sizes = merged, merged_sizes
+
+    cursor = np.cumsum(sizes) - sizes  # next rank to give out in each bucket
+    for start in range(0, len(counts), block):
+        bucket = np.searchsorted(buckets, bucket_keys(start))
+        order = np.argsort(bucket, kind='stable')
+        block_sizes = np.bincount(bucket, minlength=len(buckets))
+        # Position of each entry among the entries of its bucket in this block
+        within = np.empty(len(bucket), dtype=np.int64)
+        within[order] = np.arange(len(bucket)) - np.repeat(np.cumsum(block_sizes) - block_sizes, block_sizes)
+        out[start:start + len(bucket)] = cursor[bucket] + within
+        cursor += block_sizes
+
+
+class FacetWriter:
+    """Facet arrays written chunk by chunk: codes go straight to a memory-mapped
+    array, and values get codes in order of first appearance, as Facet.build()
+    assigns them. Only the distinct values are held in memory."""
+
+    def __init__(self, directory, name, n_rows):
+        self.directory = directory
+        self.name = name
+        self.codes = open_array(directory, name, 'codes', np.int32, (n_rows,))
+        self.positions = {}  # normalized value -> code
+        self.keys = []
+        self.labels = []
+
+    def add(self, series, first_row):
+        raw = text_values(series).str.strip()
+        local_codes, local_keys = pd.factorize(raw.str.lower())
+        first_rows = np.unique(local_codes, return_index=True)[1]
+        mapping = np.empty(len(local_keys), dtype=np.int32)
+        for i, (key, label) in enumerate(zip(local_keys, raw.to_numpy()[first_rows])):
+            if not key:
+                mapping[i] = -1  # Rows without a value
+                continue
+            code = self.positions.get(key)
+            if code is None:
+                code = self.positions[key] = len(self.keys)
+                self.keys.append(key)
+                self.labels.append(label)
+            mapping[i] = code
+        self.codes[first_row:first_row + len(raw)] = mapping[local_codes]
+
+    def close(self):
+        self.codes.flush()
+        save_arrays(self.directory, self.name, {'keys': np.array(self.keys, dtype=str),
+                                                'labels': np.array(self.labels, dtype=str)})
+
+
+class FeatureWriter:
+    """FeatureMatrix arrays for a catalog read in chunks. The raw values are
+    spilled to a memory-mapped scratch array while the column sums are
+    accumulated; the deviations and the standardized rows are then computed
+    over it a block at a time."""
+
+    def __init__(self, directory, temp, columns, n_rows):
+        self.directory = directory
+        self.columns = columns
+        self.values = np.lib.format.open_memmap(os.path.join(temp, 'audio_values.npy'), mode='w+',
+                                                dtype=np.float64, shape=(n_rows, len(columns)))
+        self.present = np.zeros(len(columns), dtype=np.int64)
+        self.total = np.zeros(len(columns))
+
+    def add(self, frame, first_row):
+        values = frame[self.columns].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+        self.values[first_row:first_row + len(values)] = values
+        self.present += np.count_nonzero(~np.isnan(values), axis=0)
+        self.total += np.nansum(values, axis=0)
+
+    def close(self, block=RUN_READ_ROWS):
+        n_rows = len(self.values)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.nan_to_num(self.total / self.present)
+            squares = np.zeros(len(self.columns))
+            for start in range(0, n_rows, block):
+                squares += np.nansum((self.values[start:start + block] - mean) ** 2, axis=0)
+            scale = np.nan_to_num(np.sqrt(squares / self.present))
+        scale[scale == 0] = 1
+
+        features = FeatureMatrix(self.columns, None, mean, scale)
+        vectors = open_array(self.directory, 'audio_features', 'vectors', np.float32, (n_rows, len(self.columns)))
+        for start in range(0, n_rows, block):
+            vectors[start:start + block] = features.standardize(self.values[start:start + block])
+        vectors.flush()
+        save_arrays(self.directory, 'audio_features', {'columns': np.array(self.columns, dtype=str),
+                                                       'mean': mean, 'scale': scale})
+
+
+def write_indexes(directory, frames, n_rows, facet_columns, max_suggestions):
+    """Write the lookup indexes build_indexes() makes for a catalog given as a
+    stream of chunks (DataFrames with the index columns), as the components
+    index_components() stores. Returns the component names written."""
+    temp = tempfile.mkdtemp(prefix='indexes-', dir=directory)
+    try:
+        title_trigrams = TrigramWriter(directory, 'title_trigrams', temp)
+        artist_trigrams = TrigramWriter(directory, 'artist_trigrams', temp)
+        title_order = TitleOrderWriter(directory, temp)
+        suggest = PrefixWriter(directory, temp, max_suggestions)
+        facets = {column: FacetWriter(directory, f'facet_{column}', n_rows) for column in facet_columns}
+        years = open_array(directory, 'years', 'years', np.float64, (n_rows,))
+        features = None
+
+        row = 0
+        for frame in frames:
+            if row == 0:
+                columns = [column for column in AUDIO_FEATURE_COLUMNS if column in frame.columns]
+                if columns:
+                    features = FeatureWriter(directory, temp, columns, n_rows)
+            titles = text_values(frame['track_name'])
+            artists = text_values(frame['artist_name'])
+            chunk_years = build_year_array(frame)
+
+            title_index = TrigramIndex.build(titles)
+            title_trigrams.add(title_index, row)
+            artist_trigrams.add(TrigramIndex.build(artists), row)
+            title_order.add(title_index.texts, row)
+            suggest.add(titles, artists, chunk_years)
+            for column, facet in facets.items():
+                facet.add(frame[column], row)
+            years[row:row + len(frame)] = chunk_years
+            if features is not None:
+                features.add(frame, row)
+            row += len(frame)
+            print(f"Indexed {row}/{n_rows} rows")
+        if row != n_rows:
+            raise ValueError(f"The catalog changed while the indexes were built ({row} rows, expected {n_rows})")
+
+        print("Merging index runs...")
+        title_trigrams.close()
+        artist_trigrams.close()
+        title_order.close(n_rows)
+        suggest.close()
+        for facet in facets.values():
+            facet.close()
+        years.flush()
+        if features is not None:
+            features.close()
+    finally:
+        shutil.rmtree(temp, ignore_errors=True)
+
+    names = ['title_trigrams', 'artist_trigrams', 'title_index', 'suggest_index', 'years',
+             *(f'facet_{column}' for column in facet_columns)]
+    if features is not None:
+        names.append('audio_features')
+    return names
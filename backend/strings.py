@@ -0,0 +1,199 @@
+import numpy as np
+
+
+class StringColumn:
+    """Immutable column of strings held as one UTF-8 byte buffer plus offsets.
+
+    There are no per-row Python objects, so the column can be memory-mapped
+    from disk and shared between worker processes without reference counting
+    dirtying its pages. Strings are decoded only when read."""
+
+    def __init__(self, buffer, offsets):
+        self.buffer = buffer  # uint8, all strings back to back
+        self.offsets = offsets  # int64, len(self) + 1; row i is buffer[offsets[i]:offsets[i + 1]]
+
+    @classmethod
+    def from_strings(cls, values):
+        """Encode an iterable of strings (None is stored as the empty string)"""
+        encoded = [b'' if value is None else str(value).encode('utf-8') for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)), out=offsets[1:])
+        buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(buffer, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        start = int(self.offsets[row])
+        stop = int(self.offsets[row + 1])
+        return self.buffer[start:stop].tobytes().decode('utf-8')
+
+    def take(self, rows):
+        """Decoded strings for several rows"""
+        return [self[row] for row in rows]
+
+    def to_list(self):
+        """Every string, decoded in one pass over the buffer"""
+        data = self.buffer.tobytes()
+        offsets = self.offsets.tolist()
+        return [data[start:stop].decode('utf-8') for start, stop in zip(offsets, offsets[1:])]
+
+    def subset(self, rows):
+        """New column holding the strings of rows, in the given order, gathered
+        from the buffer in one vectorized copy"""
+        rows = np.asarray(rows, dtype=np.intp)
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        index = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return StringColumn(self.buffer[index], offsets)
+
+    def occurrences(self, needle):
+        """(rows, positions) of every occurrence of needle inside a string, in
+        buffer order: the row and the match's byte offset in the buffer.
+
+        Matching is vectorized over the raw buffer: positions holding the
+        first byte of needle are narrowed down one byte at a time. UTF-8 is
+        self-synchronizing, so byte matches are character matches."""
+        needle = np.frombuffer(needle.encode('utf-8'), dtype=np.uint8)
+        if not 0 < len(needle) <= len(self.buffer):
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        positions = np.flatnonzero(self.buffer[:len(self.buffer) - len(needle) + 1] == needle[0])
+        for i in range(1, len(needle)):
+            positions = positions[self.buffer[positions + i] == needle[i]]
+        rows = np.searchsorted(self.offsets, positions, side='right') - 1
+        # A hit that runs past the end of its row spans two strings
+        inside = positions + len(needle) <= self.offsets[rows + 1]
+        return rows[inside], positions[inside]
+
+    def concat(self, other):
+        """New column holding this column's strings followed by other's"""
+        buffer = np.concatenate([self.buffer, other.buffer])
+        offsets = np.concatenate([self.offsets, other.offsets[1:] + self.offsets[-1]])
+        return StringColumn(buffer, offsets)
+
+    def append(self, values):
+        """New column with strings added at the end (this one is left unchanged)"""
+        return self.concat(StringColumn.from_strings(values))
+
+    def arrays(self):
+        """Backing arrays, for persisting the column"""
+        return {'buffer': self.buffer, 'offsets': self.offsets}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['buffer'], arrays['offsets'])
+
+
+class CategoryColumn:
+    """Dictionary-encoded column for strings that repeat (genres, moods, artists).
+
+    Each distinct string is stored once in a StringColumn of categories and
+    rows hold the smallest integer code that fits; code -1 marks a missing
+    value, which reads back as None."""
+
+    def __init__(self, codes, categories):
+        self.codes = codes  # int8/int16/int32 per row
+        self.categories = categories  # StringColumn of distinct values
+
+    @classmethod
+    def from_codes(cls, codes, categories):
+        """Column from factorized codes and their distinct strings"""
+        return cls(np.asarray(codes).astype(code_dtype(len(categories))), StringColumn.from_strings(categories))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, row):
+        code = int(self.codes[row])
+        return None if code < 0 else self.categories[code]
+
+    def take(self, rows):
+        """Decoded strings for several rows; each distinct value is decoded once"""
+        codes = self.codes[np.asarray(rows, dtype=np.intp)]
+        distinct = np.unique(codes[codes >= 0])
+        decoded = dict(zip(distinct.tolist(), self.categories.take(distinct)))
+        return [decoded.get(code) for code in codes.tolist()]
+
+    def to_list(self):
+        categories = self.categories.to_list()
+        return [None if code < 0 else categories[code] for code in self.codes.tolist()]
+
+    def append(self, values):
+        """New column with values added at the end; unseen strings get the next codes"""
+        categories = self.categories.to_list()
+        positions = {value: code for code, value in enumerate(categories)}
+        new_categories = []
+        codes = np.empty(len(values), dtype=np.int64)
+        for i, value in enumerate(values):
+            if value is None:
+                codes[i] = -1
+                continue
+            code = positions.get(value)
+            if code is None:
+                code = positions[value] = len(categories) + len(new_categories)
+                new_categories.append(value)
+            codes[i] = code
+        dtype = code_dtype(len(categories) + len(new_categories))
+        return CategoryColumn(
+            np.concatenate([self.codes.astype(dtype), codes.astype(dtype)]),
+            self.categories.append(new_categories),
+        )
+
+    def arrays(self):
+        arrays = {'codes': self.codes}
+        arrays.update(nested_arrays('categories', self.categories.arrays()))
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['codes'], StringColumn.from_arrays(child_arrays('categories', arrays)))
+
+
+def code_dtype(count):
+    """Smallest signed integer type holding codes 0..count-1 and -1"""
+    for dtype in (np.int8, np.int16, np.int32):
+        if count <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def integer_dtype(values):
+    """Smallest signed integer type holding every value in an integer array"""
+    if len(values) == 0:
+        return np.int16
+    low, high = int(values.min()), int(values.max())
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return np.int64
+
+
+class SortedView:
+    """Read-only sequence of column[order[i]], so bisect can search a column
+    through a sorted permutation without materializing the sorted strings"""
+
+    def __init__(self, column, order):
+        self.column = column
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, i):
+        return self.column[self.order[i]]
+
+
+def nested_arrays(prefix, arrays):
+    """Prefix the keys of a child object's arrays so they can be stored alongside the parent's"""
+    return {f'{prefix}.{key}': value for key, value in arrays.items()}
+
+
+def child_arrays(prefix, arrays):
+    """Inverse of nested_arrays: the arrays stored under prefix, with it stripped"""
+    prefix = prefix + '.'
+    # Only the matching arrays are read, so a lazily loaded mapping opens no others
+    return {key[len(prefix):]: arrays[key] for key in arrays if key.startswith(prefix)}
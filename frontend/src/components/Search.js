@@ -8,12 +8,14 @@ const API_BASE = process.env.REACT_APP_API_URL || '';
 const Search = () => {
   const [query, setQuery] = useState('');
   const [results, setResults] = useState([]);
+  const [total, setTotal] = useState(0);
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState('');
 
   const searchSongs = async (searchQuery) => {
     if (!searchQuery.trim()) {
       setResults([]);
+      setTotal(0);
       return;
     }
 
@@ -23,9 +25,11 @@ const Search = () => {
     try {
       const response = await axios.get(`${API_BASE}/api/search?q=${encodeURIComponent(searchQuery)}`);
       setResults(response.data.results || []);
+      setTotal(response.data.total ?? (response.data.results || []).length);
     } catch (err) {
       setError('Failed to search songs. Please try again.');
       setResults([]);
+      setTotal(0);
     } finally {
       setLoading(false);
     }
@@ -139,7 +143,7 @@ const Search = () => {
           >
             <div className="text-center mb-6">
               <h2 className="text-2xl font-semibold text-white">
-                Found {results.length} result{results.length !== 1 ? 's' : ''}
+                Found {total} result{total !== 1 ? 's' : ''}
               </h2>
             </div>
 